@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+'''
+client for the resident alignment server started with aligner.py --serve SOCKET
+
+messages are single lines of json sent over the unix socket, each answered by one line of json:
+    {"command": "submit", "job": {"sample": ..., "r1": ..., "r2": ..., "out_dir": ...}} -> {"jobid": ..., "state": "queued"}
+    {"command": "status", "jobid": ...} -> {"state": "queued|running|done|failed", ...}
+    {"command": "wait", "jobid": ...} -> same as status, once the job is done or failed
+    {"command": "shutdown", "when": "idle|now"} -> {"state": "stopping"}
+only the standard library is imported here so submitting a job starts instantly
+'''
+
+def request(socket_path, message):
+    '''
+    @param socket_path: unix socket the server listens on
+    @param message: dictionary to send
+    @return: dictionary the server replied with
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        with client.makefile('rw') as stream:
+            stream.write(json.dumps(message) + "\n")
+            stream.flush()
+            reply = json.loads(stream.readline())
+    finally:
+        client.close()
+    if 'error' in reply and 'state' not in reply:
+        raise RuntimeError("alignment server on %s: %s" % (socket_path, reply['error']))
+    return reply
+
+def submitSample(socket_path, sample, read1, read2, out_dir):
+    '''
+    @param socket_path: unix socket the server listens on
+    @param sample: sample name
+    @param read1, read2: read files of sample, read2 is '' if reads are not paired
+    @param out_dir: directory the server writes the sample's log and metrics to
+    @return: job id the server gave the sample
+    '''
+    job = {'sample': sample, 'r1': read1, 'r2': read2, 'out_dir': out_dir}
+    return request(socket_path, {'command': 'submit', 'job': job})['jobid']
+
+def jobStatus(socket_path, jobid):
+    '''
+    @return: dictionary with the state of jobid, plus its metrics file when done or error when failed
+    '''
+    return request(socket_path, {'command': 'status', 'jobid': jobid})
+
+def waitJob(socket_path, jobid):
+    '''
+    @return: dictionary with the final state of jobid, blocking until it is done or failed
+    '''
+    return request(socket_path, {'command': 'wait', 'jobid': jobid})
+
+def shutdownServer(socket_path, when='idle'):
+    '''
+    @param when: 'idle' to stop once every queued job is finished, 'now' to stop after the running job
+    '''
+    return request(socket_path, {'command': 'shutdown', 'when': when})
+
+def startServer(socket_path, server_args, log_file=os.devnull, timeout=600):
+    '''
+    @param socket_path: unix socket the server should listen on
+    @param server_args: list of aligner.py arguments describing the reference, e.g. ['-f', fasta, '--index', index_file]
+    @param log_file: file the server's stdout and stderr go to
+    @param timeout: seconds to wait for the server to load the reference and start listening
+    @return: subprocess.Popen of the server
+    '''
+    import subprocess
+    aligner_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aligner.py")
+    with open(log_file, 'a') as log:
+        proc = subprocess.Popen([sys.executable, aligner_py, "--serve", socket_path] + list(server_args), stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("alignment server exited with status %d, see %s" % (proc.returncode, log_file))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            return proc
+        except OSError:
+            pass
+        finally:
+            probe.close()
+        time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("alignment server did not start listening on %s within %d seconds" % (socket_path, timeout))
+
+def stopServer(socket_path, proc, timeout=30):
+    '''
+    @param socket_path: unix socket the server listens on
+    @param proc: subprocess.Popen of the server as returned by startServer
+    @param timeout: seconds to let the server finish its running job and exit before it is terminated
+    @return: exit status of the server
+    '''
+    import subprocess
+    if proc.poll() is None:
+        try:
+            shutdownServer(socket_path, 'now')
+            proc.wait(timeout)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            #the server is stuck or no longer answering, so it is stopped without finishing the running job
+            proc.terminate()
+            try:
+                proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+    #a terminated server does not get to remove its socket
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    return proc.returncode
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("socket", help="unix socket the alignment server listens on")
+    parser.add_argument("command", choices=['submit', 'status', 'wait', 'shutdown'], help="request to send")
+    parser.add_argument("-s", "--sample", dest="sample", help="name of sample to submit")
+    parser.add_argument("-r1", "--read_file1", dest="r1", help="read file of read1s to submit")
+    parser.add_argument("-r2", "--read_file2", dest="r2", default='', help="read file of read2s to submit [default: '']")
+    parser.add_argument("-o", "--out-dir", dest="odir", default=os.getcwd(), help="directory the server writes output to [default: `pwd`]")
+    parser.add_argument("--jobid", dest="jobid", help="job to get the status of or wait for")
+    parser.add_argument("--now", dest="now", action="store_true", help="shut down without finishing queued jobs")
+    args = parser.parse_args()
+    if args.command == 'submit':
+        if not args.sample or not args.r1:
+            parser.error("submit needs -s and -r1")
+        print(submitSample(args.socket, args.sample, os.path.abspath(args.r1), os.path.abspath(args.r2) if args.r2 else '', os.path.abspath(args.odir)))
+    elif args.command == 'shutdown':
+        print(json.dumps(shutdownServer(args.socket, 'now' if args.now else 'idle')))
+    else:
+        if not args.jobid:
+            parser.error("%s needs --jobid" % args.command)
+        reply = jobStatus(args.socket, args.jobid) if args.command == 'status' else waitJob(args.socket, args.jobid)
+        print(json.dumps(reply))
+        return 0 if reply.get('state') != 'failed' else 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,150 +1,913 @@
 import argparse
 import os
+import sys
+import gzip
 import logging
-from collections import defaultdict
-from skbio import TabularMSA, DNA
-from itertools import zip_longest
+import time
+from collections import namedtuple, Counter, OrderedDict
+from itertools import zip_longest, chain, islice
 
 
-import dispatcher
+import metrics
+
+ref_coords = namedtuple('ref_coords', ['names', 'starts', 'ends'])
+placement = namedtuple('placement', ['ref_id', 'start', 'end', 'clip_left', 'clip_right'])
+
+def buildCoordinates(reference_locs):
+    '''
+    @param reference_locs: a dictionary with key = ref name and value = [position the reference starts, pos ref ends]
+    @return: ref_coords with the reference names and arrays of their starts and ends in combined_ref, sorted by start
+    '''
+    import numpy as np
+    names = sorted(reference_locs, key=lambda name: reference_locs[name][0])
+    starts = np.array([reference_locs[name][0] for name in names], dtype=np.int64)
+    ends = np.array([reference_locs[name][1] for name in names], dtype=np.int64)
+    return ref_coords(names, starts, ends)
+
+def resolveCoordinates(coords, read_starts, read_ends):
+    '''
+    @param coords: ref_coords as made by buildCoordinates
+    @param read_starts, read_ends: arrays of start and end (exclusive) offsets of placements in combined_ref
+    @return: placement of arrays, ref_id indexes coords.names (-1 if the placement overlaps no reference), start and end are
+             local coordinates in that reference and clip_left, clip_right are the bases hanging off its start and end
+    '''
+    import numpy as np
+    read_starts = np.asarray(read_starts, dtype=np.int64)
+    read_ends = np.asarray(read_ends, dtype=np.int64)
+    #the padding between references is as long as a read, so a placement can only overlap the first reference ending after it starts
+    ref_id = np.searchsorted(coords.ends, read_starts, side='right')
+    in_panel = ref_id < len(coords.ends)
+    ref_id = np.where(in_panel, ref_id, -1)
+    ref_start = coords.starts[ref_id]
+    ref_end = coords.ends[ref_id]
+    start = np.maximum(read_starts, ref_start) - ref_start
+    end = np.minimum(read_ends, ref_end) - ref_start
+    ref_id[~in_panel | (end <= start)] = -1
+    clip_left = np.maximum(ref_start - read_starts, 0)
+    clip_right = np.maximum(read_ends - ref_end, 0)
+    for field in (start, end, clip_left, clip_right):
+        field[ref_id == -1] = 0
+    return placement(ref_id, start, end, clip_left, clip_right)
+
+def readFasta(fasta):
+    '''
+    @param fasta: path to a plain or gzipped fasta file, sequences may be wrapped over any number of lines
+    @return: generator of (ref name, line) for every sequence line in fasta, uppercased, as bytes, ref name is the header up to its first whitespace
+    '''
+    ref_name = None
+    with openFile(fasta, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line[:1] == b'>':
+                #the rest of the header is a description, SAM and the outputs only take the name
+                ref_name = (line[1:].decode().split(None, 1) or [''])[0]
+            elif ref_name is None:
+                raise ValueError("%s does not start with a fasta header" % fasta)
+            else:
+                yield ref_name, line.upper()
 
 def processFasta(fasta, read_length):
     '''
-    @param fasta: name of file in fasta format of reference sequences to align to
-    @return combined_ref: a string with read_length x's between each reference seq
+    @param fasta: name of file in fasta format of reference sequences to align to, may be gzipped and wrapped
+    @return combined_ref: a bytearray with read_length x's between each reference seq
     @return reference_locs: a dictionary with key = ref name and value = position the reference starts, pos ref ends
+    @return x_locs: list of form [start x region, end x region, start x region 2, ...]
+    @return coords: ref_coords for translating combined_ref offsets to reference names and local positions
     '''
-    f = open(fasta, 'r')
-    #create read_length length stirng of x's
-    x = ""
-    for i in range(read_length):
-        x += 'x'
-    #readlines() returns a list with ith line as ith element
-    lines = f.readlines()
-    combined_ref = ""
+    #first pass only measures the references so combined_ref can be allocated once at its final size
+    ref_lens = []
+    for ref_name, line in readFasta(fasta):
+        if not ref_lens or ref_lens[-1][0] != ref_name:
+            ref_lens.append([ref_name, 0])
+        ref_lens[-1][1] += len(line)
     reference_locs = dict()
     x_locs = []
+    ref_starts = []
     pos = 0
-    for i in range(0, len(lines)-1, 2):
-        ref_name = lines[i][1:-1]
-        ref_seq = lines[i+1][:-1]
-        ref_len = len(ref_seq)
+    for ref_name, ref_len in ref_lens:
+        if ref_name in reference_locs:
+            logging.warning("Reference %s appears more than once in %s, only the last copy can be reported" % (ref_name, fasta))
         reference_locs[ref_name] = [pos, pos + ref_len]
+        ref_starts.append(pos)
         x_locs.append(pos + ref_len)
         x_locs.append(pos + ref_len + read_length)
-        combined_ref += ref_seq
-        combined_ref += x
         #increment positon by amount of new combined_ref created which is length of reference added plus length of x's added
         pos += read_length + ref_len
-    return combined_ref, reference_locs, x_locs
+    #second pass copies sequence lines into a buffer that is all x's to start with, leaving the padding in place
+    combined_ref = bytearray(b'x') * pos
+    record = -1
+    last_name = None
+    for ref_name, line in readFasta(fasta):
+        if ref_name != last_name:
+            record += 1
+            pos = ref_starts[record]
+            last_name = ref_name
+        combined_ref[pos:pos + len(line)] = line
+        pos += len(line)
+    return combined_ref, reference_locs, x_locs, buildCoordinates(reference_locs)
 
-def hashReferences(ref_file, read_length, hash_length=5):
+def hashReferences(ref_file, read_length, hash_length=0, run_metrics=None, window=0, max_occurrences=0):
     '''
     @param ref_file: a path to reference file
     @param read_length: read length
-    @return hash_table: a dictionary with keys=key_size length seqs of ref and values=positions in combined ref where this seq exist
+    @param hash_length: k-mer length, 0 to pick it from the size of the references and read_length
+    @param run_metrics: optional metrics.RunMetrics to record processFasta and hashReferences stage times in
+    @param window: minimizer window, 0 to pick it from hash_length and read_length, 1 to index every k-mer
+    @param max_occurrences: see kmerindex.buildIndex
+    @return index: a kmerindex.kmer_index of the combined reference, positions of each hash_length length seq of ref are an array slice
     @return reference_locs: a dictionary storing where each ref is in combined ref. key=ref name value=[start, end]
+    @return x_locs: list of form [start x region, end x region, start x region 2, ...]
+    @return combined_ref: a bytearray with read_length x's between each reference seq
+    @return coords: ref_coords for translating combined_ref offsets to reference names and local positions
     '''
+    import kmerindex
+    if run_metrics is None:
+        run_metrics = metrics.RunMetrics(None)
     #create combined reference
-    combined_ref, reference_locs, x_locs = processFasta(ref_file, read_length)
-    #create hash table, repeated elements have their locations put in a list
-    hash_table = defaultdict(list)
-    for i in range(len(combined_ref)-(hash_length - 1)):
-        hash_table[combined_ref[i:i + hash_length]].append(i)
-    return hash_table, reference_locs, x_locs, combined_ref
+    with run_metrics.stage('processFasta'):
+        combined_ref, reference_locs, x_locs, coords = processFasta(ref_file, read_length)
+    if hash_length <= 0:
+        hash_length = kmerindex.autoHashLength(sum(end - start for start, end in reference_locs.values()), read_length)
+    if window <= 0:
+        window = kmerindex.autoWindow(hash_length, read_length)
+    #create packed k-mer index, repeated elements have their sorted locations stored contiguously
+    with run_metrics.stage('hashReferences'):
+        index = kmerindex.buildIndex(combined_ref, hash_length, read_length, reference_locs, x_locs, window, max_occurrences)
+    return index, reference_locs, x_locs, combined_ref, coords
 
-def getReads(read1_file, read2_file = ''):
+fastq_record = namedtuple('fastq_record', ['name', 'seq', 'qual'])
+
+def openFile(path, mode='rt'):
+    '''
+    @param path: path to a plain or gzip compressed file
+    @param mode: mode to open file in
+    @return: file object, transparently decompressing if the file is gzipped
     '''
-    @param read_list: a list of tuples named Read that contain the sample name followed by an array containing one element, a path to the merged read file, or 2 elements, paths to read1 and read2 files
-    @return:
+    #check the magic number rather than the extension so misnamed files still work
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def readFastq(read_file):
     '''
-    #put reads into tabulr multiple sequence alignment structures
-    msa1 = TabularMSA.read(read1_file, constructor=DNA, variant='illumina1.8')
+    @param read_file: path to a plain or gzipped fastq file
+    @return: generator of fastq_records, one per read, parsed lazily from read_file
+    '''
+    with openFile(read_file) as f:
+        while True:
+            header = f.readline()
+            if not header:
+                return
+            #blank lines between records or at the end of the file are not records
+            if not header.strip():
+                continue
+            seq = f.readline().rstrip()
+            plus = f.readline()
+            qual = f.readline().rstrip()
+            if header[0] != '@' or not plus.startswith('+') or len(seq) != len(qual):
+                raise ValueError("Malformed fastq record %s in %s" % (header.rstrip(), read_file))
+            yield fastq_record(header[1:].rstrip(), seq.upper(), qual)
+
+def getReads(read1_file, read2_file='', batch_size=10000, first_read=0, last_read=-1):
+    '''
+    @param read1_file: path to read1 (or merged/unpaired) fastq file, may be gzipped
+    @param read2_file: path to read2 fastq file, '' if reads are not paired
+    @param batch_size: maximum number of reads (or read pairs) per batch
+    @param first_read, last_read: only yield reads first_read up to but not including last_read, -1 to read to the end of the file
+    @return: generator of lists of at most batch_size fastq_records, or (read1, read2) tuples of fastq_records when paired
+    '''
+    reads = readFastq(read1_file)
     if read2_file != '':
-        msa2 = TabularMSA.read(read2_file, constructor=DNA, variant='illumina1.8')
-        return msa1, msa2
-    return msa1
-
-def in_range(range_list, value, start):
-    '''
-    @param range_list: a SORTED FROM SMALLER TO LARGER list of form [start, end, start(bigger than last start), end(bigger than last end)...] with start and end representing ranges
-    @param value: value to check if is in a range of range_list
-    @param start: bool=True when value is start of read and False when end of read
-    @return: list with range of where value is in a range of range_list
-    '''
-    present_range = []
-    for i in range(0, len(range_list), 2):
-
-        if range_list[i] <= value:
-            if value <= range_list[i + 1]:
-                if start:
-                    present_range.append(value)
-                    present_range.append(range_list[i + 1])
-                    #can return because will only be in one range
-                    return present_range
-                else:
-                    present_range.append(range_list[i])
-                    present_range.append(value)
-                    return present_range
+        #walk both files in lockstep, fillvalue marks one file running out before the other
+        reads = zip_longest(reads, readFastq(read2_file))
+    if first_read > 0 or last_read >= 0:
+        #gzip can not seek, so reads before a shard are still parsed but never aligned
+        reads = islice(reads, first_read, last_read if last_read >= 0 else None)
+    batch = []
+    for read in reads:
+        if read2_file != '' and None in read:
+            raise ValueError("%s and %s have different numbers of reads" % (read1_file, read2_file))
+        batch.append(read)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+alignment_result = namedtuple('alignment_result', ['loc', 'diff', 'aligned', 'n_best', 'cigar'])
+
+def encodeReads(seqs):
+    '''
+    @param seqs: list of read sequence strings
+    @return read_bytes: uint8 array with one row per read, rows are padded with 0's to one more than the longest read so no k-mer spans two reads
+    @return read_lengths: array of read lengths
+    '''
+    import numpy as np
+    read_lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    width = (int(read_lengths.max()) if len(seqs) else 0) + 1
+    read_bytes = np.zeros((len(seqs), width), dtype=np.uint8)
+    flat = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(seqs)), read_lengths)
+    cols = np.arange(len(flat)) - np.repeat(np.cumsum(read_lengths) - read_lengths, read_lengths)
+    read_bytes[rows, cols] = flat
+    return read_bytes, read_lengths
+
+def seedCandidates(index, read_bytes, hash_length, counters=None):
+    '''
+    @param index: kmerindex.kmer_index of combined_ref
+    @param read_bytes: encoded reads as made by encodeReads
+    @param hash_length: k-mer length of index
+    @param counters: optional collections.Counter to add seed_lookups, seed_misses, seed_hits (total posting list length) and diagonals counts to
+    @return cand_reads: read (row of read_bytes) of each candidate, sorted
+    @return cand_starts: position in combined_ref the read would start at for each candidate (its diagonal), may be negative or in x padding
+    @return votes: number of seeds of the read that hit each candidate
+    '''
+    import numpy as np
+    import kmerindex
+    width = read_bytes.shape[1]
+    #search every hash_length fragment of every read in index of references at once, or only their minimizers if that is all index holds
+    codes, valid = kmerindex.encodeKmers(read_bytes.ravel(), hash_length)
+    seed_pos = kmerindex.minimizerPositions(codes, valid, index.window)
+    starts, ends = kmerindex.lookup(index, codes[seed_pos])
+    counts = ends - starts
+    #expand each seed into one hit per location it was found at in the reference
+    hit_seed = np.repeat(np.arange(len(seed_pos)), counts)
+    hit_index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+    hit_pos = seed_pos[hit_seed]
+    cand_reads = hit_pos // width
+    cand_starts = index.positions[hit_index].astype(np.int64) - hit_pos % width
+    #every seed from the same placement of a read lies on the same diagonal, keep one window per diagonal and count its seeds
+    span = len(index.combined_ref) + 2 * width
+    keys = np.sort(cand_reads * span + cand_starts + width)
+    first = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))[:len(keys)]
+    votes = np.diff(np.append(first, len(keys)))
+    keys = keys[first]
+    if counters is not None:
+        counters['seed_lookups'] += len(seed_pos)
+        counters['seed_misses'] += int((counts == 0).sum())
+        counters['seed_hits'] += len(hit_pos)
+        counters['diagonals'] += len(keys)
+    return keys // span, keys % span - width, votes
+
+def rankCandidates(cand_reads, cand_starts, votes, max_candidates):
+    '''
+    @param cand_reads, cand_starts, votes: candidates as made by seedCandidates
+    @param max_candidates: number of most voted candidates to keep per read, all are kept if < 1
+    @return: cand_reads, cand_starts, votes of the kept candidates sorted by read then most votes first, and the rank of each within its read
+    '''
+    import numpy as np
+    order = np.lexsort((cand_starts, -votes, cand_reads))
+    cand_reads, cand_starts, votes = cand_reads[order], cand_starts[order], votes[order]
+    first = np.flatnonzero(np.concatenate(([True], cand_reads[1:] != cand_reads[:-1]))) if len(cand_reads) else np.zeros(0, dtype=np.int64)
+    rank = np.arange(len(cand_reads)) - np.repeat(first, np.diff(np.append(first, len(cand_reads))))
+    if max_candidates > 0:
+        keep = rank < max_candidates
+        cand_reads, cand_starts, votes, rank = cand_reads[keep], cand_starts[keep], votes[keep], rank[keep]
+    return cand_reads, cand_starts, votes, rank
+
+def verifyCandidates(ref_bytes, read_bytes, read_lengths, cand_reads, cand_starts, max_cells=1 << 24):
+    '''
+    @param ref_bytes: uint8 array of combined_ref
+    @param read_bytes, read_lengths: encoded reads as made by encodeReads
+    @param cand_reads, cand_starts: candidate windows as made by seedCandidates
+    @param max_cells: maximum number of bases compared in one numpy pass, bounds memory use
+    @return diffs: number of mismatches of each candidate
+    @return aligned: number of bases compared for each candidate, bases where the read hangs off its reference into the x's (or past either end of combined_ref) are trimmed
+    '''
+    import numpy as np
+    width = read_bytes.shape[1]
+    #pad with x's so windows hanging past either end of combined_ref are trimmed like any other overhang
+    padding = np.full(width, ord('x'), dtype=np.uint8)
+    padded_ref = np.concatenate((padding, ref_bytes, padding))
+    cols = np.arange(width)
+    diffs = np.zeros(len(cand_reads), dtype=np.int64)
+    aligned = np.zeros(len(cand_reads), dtype=np.int64)
+    chunk = max(1, max_cells // width)
+    for i in range(0, len(cand_reads), chunk):
+        ref_window = padded_ref[cand_starts[i:i + chunk, None] + width + cols]
+        read_window = read_bytes[cand_reads[i:i + chunk]]
+        #rows of read_bytes are padded with 0's past the end of the read
+        compared = (ref_window != ord('x')) & (read_window != 0)
+        diffs[i:i + chunk] = ((ref_window != read_window) & compared).sum(axis=1)
+        aligned[i:i + chunk] = compared.sum(axis=1)
+    return diffs, aligned
+
+def bestHits(n_reads, cand_reads, cand_starts, diffs, aligned):
+    '''
+    @param n_reads: number of reads in batch
+    @param cand_reads, cand_starts: candidate windows as made by seedCandidates
+    @param diffs, aligned: verification of candidates as made by verifyCandidates
+    @return: alignment_result of arrays with one element per read, loc is the leftmost of the placements with the most matching
+             bases then fewest mismatches (-1 if read had no candidates), n_best is the number of placements tied with it and
+             cigar is '' as placements along a diagonal have no indels
+    '''
+    import numpy as np
+    loc = np.full(n_reads, -1, dtype=np.int64)
+    best_diff = np.full(n_reads, -1, dtype=np.int64)
+    best_aligned = np.zeros(n_reads, dtype=np.int64)
+    n_best = np.zeros(n_reads, dtype=np.int64)
+    cigar = np.full(n_reads, '', dtype=object)
+    if len(cand_reads) == 0:
+        return alignment_result(loc, best_diff, best_aligned, n_best, cigar)
+    #sort by read, then most matches, then fewest mismatches, then leftmost so the first candidate of each read is its best
+    #ranking on matches keeps a placement that only overlaps the reference by a few bases from beating the real one
+    matches = aligned - diffs
+    order = np.lexsort((cand_starts, diffs, -matches, cand_reads))
+    sorted_reads = cand_reads[order]
+    best = order[np.concatenate(([True], sorted_reads[1:] != sorted_reads[:-1]))]
+    mapped = cand_reads[best]
+    loc[mapped] = cand_starts[best]
+    best_diff[mapped] = diffs[best]
+    best_aligned[mapped] = aligned[best]
+    ties = np.flatnonzero((diffs == best_diff[cand_reads]) & (matches == best_aligned[cand_reads] - best_diff[cand_reads]))
+    #windows realigned with indels can land on the same placement, count each placement once
+    tied = np.unique(np.stack((cand_reads[ties], cand_starts[ties])), axis=1)
+    n_best[:] = np.bincount(tied[0], minlength=n_reads)
+    return alignment_result(loc, best_diff, best_aligned, n_best, cigar)
+
+def rescueIndels(ref_bytes, read_bytes, read_lengths, cand_reads, cand_starts, diffs, aligned, band, counters=None):
+    '''
+    @param ref_bytes: uint8 array of combined_ref
+    @param read_bytes, read_lengths: encoded reads as made by encodeReads
+    @param cand_reads, cand_starts, diffs, aligned: verified candidates, the placements an edit distance beats are updated in place
+    @param band: largest shift from its diagonal an indel may move a read by
+    @param counters: optional collections.Counter to add the edit_verified count to
+    @return: bool array marking the candidates whose placement came from edit distance, their start is approximate until traced back
+    '''
+    import numpy as np
+    import editdistance
+    rescued = np.zeros(len(cand_reads), dtype=bool)
+    #an indel turns every base after it on the diagonal into a likely mismatch, so anything short of a perfect hit is realigned
+    todo = np.flatnonzero(read_lengths[cand_reads] - aligned + diffs > 0)
+    if counters is not None:
+        counters['edit_verified'] += len(todo)
+    if len(todo):
+        reads = cand_reads[todo]
+        dists, ends = editdistance.bandedDistances(ref_bytes, read_bytes, read_lengths, reads, cand_starts[todo], band)
+        better = dists < read_lengths[reads] - aligned[todo] + diffs[todo]
+        todo, reads = todo[better], reads[better]
+        cand_starts[todo] = ends[better] - read_lengths[reads]
+        diffs[todo] = dists[better]
+        aligned[todo] = read_lengths[reads]
+        rescued[todo] = True
+    return rescued
+
+def alignBatch(index, ref_bytes, seqs, hash_length, max_candidates=16, stop_mismatches=-1, counters=None, band=0):
+    '''
+    @param index: kmerindex.kmer_index of combined_ref
+    @param ref_bytes: uint8 array of combined_ref
+    @param seqs: list of read sequence strings
+    @param hash_length: k-mer length of index
+    @param max_candidates: only the this many diagonals with the most seed votes are verified per read, all are if < 1
+    @param stop_mismatches: stop verifying a read once a placement with at most this many mismatched or overhanging bases is found, -1 to only stop on a unique perfect hit
+    @param counters: optional collections.Counter to add seeding and verification counts to
+    @param band: when > 0, candidates that are not perfect hits are also verified by banded edit distance allowing indels that shift the read up to band bases
+    @return: alignment_result with the best placement of each read in seqs, cigar is only set for reads placed with an indel
+    '''
+    import numpy as np
+    import editdistance
+    n_reads = len(seqs)
+    read_bytes, read_lengths = encodeReads(seqs)
+    cand_reads, cand_starts, votes = seedCandidates(index, read_bytes, hash_length, counters)
+    n_diagonals = len(cand_reads)
+    cand_reads, cand_starts, votes, rank = rankCandidates(cand_reads, cand_starts, votes, max_candidates)
+    diffs = np.zeros(len(cand_reads), dtype=np.int64)
+    aligned = np.zeros(len(cand_reads), dtype=np.int64)
+    verified = np.zeros(len(cand_reads), dtype=bool)
+    #cost of a placement is its mismatched bases plus the bases hanging off the reference
+    best_cost = np.full(n_reads, np.iinfo(np.int64).max, dtype=np.int64)
+    best_votes = np.zeros(n_reads, dtype=np.int64)
+    done = np.zeros(n_reads, dtype=bool)
+    #verify in rounds, the ith round checks the ith most voted diagonal of every read that is not done yet
+    for round_rank in range(int(rank.max()) + 1 if len(rank) else 0):
+        todo = np.flatnonzero((rank == round_rank) & ~done[cand_reads])
+        if len(todo) == 0:
+            break
+        reads = cand_reads[todo]
+        diffs[todo], aligned[todo] = verifyCandidates(ref_bytes, read_bytes, read_lengths, reads, cand_starts[todo])
+        verified[todo] = True
+        cost = read_lengths[reads] - aligned[todo] + diffs[todo]
+        better = cost < best_cost[reads]
+        best_cost[reads[better]] = cost[better]
+        best_votes[reads[better]] = votes[todo][better]
+        #a perfect hit is unique when every remaining diagonal has fewer votes, candidates are sorted so the next one has the most
+        next_votes = np.zeros(n_reads, dtype=np.int64)
+        has_next = todo + 1 < len(cand_reads)
+        has_next[has_next] = cand_reads[todo[has_next] + 1] == reads[has_next]
+        next_votes[reads[has_next]] = votes[todo[has_next] + 1]
+        done[reads] |= (best_cost[reads] == 0) & (best_votes[reads] > next_votes[reads])
+        done[reads] |= best_cost[reads] <= stop_mismatches
+    if counters is not None:
+        counters['verified'] += int(verified.sum())
+        counters['skipped_low_votes'] += n_diagonals - len(cand_reads)
+        counters['skipped_early_stop'] += int((~verified).sum())
+    cand_reads, cand_starts, diffs, aligned = cand_reads[verified], cand_starts[verified], diffs[verified], aligned[verified]
+    if band <= 0:
+        return bestHits(n_reads, cand_reads, cand_starts, diffs, aligned)
+    rescued = rescueIndels(ref_bytes, read_bytes, read_lengths, cand_reads, cand_starts, diffs, aligned, band, counters)
+    result = bestHits(n_reads, cand_reads, cand_starts, diffs, aligned)
+    #trace back the reads whose best placement has an indel to find exactly where they start
+    traced = np.unique(cand_reads[rescued & (cand_starts == result.loc[cand_reads])])
+    for read in traced:
+        hit = editdistance.alignOps(ref_bytes, seqs[read], int(result.loc[read]), band)
+        result.loc[read], result.diff[read], result.aligned[read], result.cigar[read] = hit.loc, hit.diff, hit.aligned, hit.cigar
+    if counters is not None:
+        counters['indel_rescued'] += len(traced)
+    return result
+
+class AlignmentCache(object):
+    '''Bounded least recently used cache of alignments of read sequences, kept across batches.'''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+    def get(self, seq):
+        '''
+        @param seq: read sequence
+        @return: cached (loc, diff, aligned, n_best, cigar) of seq, None if not cached
+        '''
+        hit = self.entries.get(seq)
+        if hit is not None:
+            self.entries.move_to_end(seq)
+        return hit
+    def put(self, seq, hit):
+        '''
+        @param seq: read sequence
+        @param hit: (loc, diff, aligned, n_best, cigar) of seq, evicting the least recently used entry if the cache is full
+        '''
+        self.entries[seq] = hit
+        self.entries.move_to_end(seq)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+def alignUnique(index, ref_bytes, seqs, hash_length, cache=None, max_candidates=16, stop_mismatches=-1, counters=None, band=0):
+    '''
+    @param index: kmerindex.kmer_index of combined_ref
+    @param ref_bytes: uint8 array of combined_ref
+    @param seqs: list of read sequence strings
+    @param hash_length: k-mer length of index
+    @param cache: optional AlignmentCache, sequences found in it are not aligned again
+    @param max_candidates, stop_mismatches, counters, band: see alignBatch
+    @return: alignment_result with the best placement of each read in seqs, each distinct sequence is only aligned once
+    '''
+    import numpy as np
+    #collapse identical reads, inverse maps each read back to its distinct sequence
+    unique = dict()
+    inverse = np.array([unique.setdefault(seq, len(unique)) for seq in seqs], dtype=np.int64)
+    unique_seqs = list(unique)
+    hits = [cache.get(seq) if cache is not None else None for seq in unique_seqs]
+    missing = [j for j, hit in enumerate(hits) if hit is None]
+    result = alignBatch(index, ref_bytes, [unique_seqs[j] for j in missing], hash_length, max_candidates, stop_mismatches, counters, band)
+    for j, hit in zip(missing, zip(*(field.tolist() for field in result))):
+        hits[j] = hit
+        if cache is not None:
+            cache.put(unique_seqs[j], hit)
+    if counters is not None:
+        counters['unique_sequences'] += len(unique_seqs)
+        counters['cache_hits'] += len(unique_seqs) - len(missing)
+    #cigars are strings, so they are kept apart from the integer fields
+    fields = np.array([hit[:-1] for hit in hits], dtype=np.int64).reshape(len(unique_seqs), len(alignment_result._fields) - 1)
+    cigars = np.array([hit[-1] for hit in hits], dtype=object)
+    return alignment_result(*(fields[inverse, i] for i in range(fields.shape[1])), cigars[inverse])
+
+def batchSeqs(batch, paired):
+    '''
+    @param batch: list of reads as yielded by getReads
+    @param paired: True when each element of batch is a (read1, read2) tuple
+    @return: list of read sequences, in order of read1_1, read2_1, read1_2, read2_2... when paired
+    '''
+    #mates are aligned separately, so identical pairs are collapsed by collapsing identical read1s and read2s
+    if paired:
+        return [read.seq for reads in batch for read in reads]
+    return [read.seq for read in batch]
+
+#per process state of alignment workers, set up once by _initWorker
+_worker = dict()
+
+def _initWorker(index_file, hash_length, max_candidates, stop_mismatches, cache_size, band):
+    '''
+    @param index_file: index file to memory-map, its pages are shared with every other process mapping it
+    @param hash_length, max_candidates, stop_mismatches, cache_size, band: see alignReads
+    '''
+    import kmerindex
+    index = kmerindex.loadIndex(index_file)
+    _worker.update(index=index, ref_bytes=index.combined_ref, hash_length=hash_length, max_candidates=max_candidates,
+                   stop_mismatches=stop_mismatches, cache=AlignmentCache(cache_size) if cache_size > 0 else None, band=band)
+
+def _alignInWorker(seqs):
+    '''
+    @param seqs: list of read sequences
+    @return: alignment_result of seqs and the Counter of work done aligning them
+    '''
+    counters = Counter()
+    result = alignUnique(_worker['index'], _worker['ref_bytes'], seqs, _worker['hash_length'], _worker['cache'],
+                         _worker['max_candidates'], _worker['stop_mismatches'], counters, _worker['band'])
+    return result, counters
+
+def alignReadsParallel(index_file, hash_length, read_batches, paired, processes, max_candidates=16, stop_mismatches=-1, counters=None, cache_size=100000, band=0):
+    '''
+    @param index_file: index file the worker processes memory-map instead of receiving a pickled copy of the index
+    @param processes: number of worker processes
+    @return: generator of (batch, alignment_result) in the same order as read_batches, see alignReads for the other parameters
+    '''
+    import multiprocessing
+    from collections import deque
+    with multiprocessing.Pool(processes, _initWorker, (index_file, hash_length, max_candidates, stop_mismatches, cache_size, band)) as pool:
+        #keep a couple of batches per worker in flight so memory stays bounded however long read_batches is
+        pending = deque()
+        for batch in chain(read_batches, [None]):
+            if batch is not None:
+                pending.append((batch, pool.apply_async(_alignInWorker, (batchSeqs(batch, paired), ))))
+            while pending and (batch is None or len(pending) >= 2 * processes):
+                done_batch, async_result = pending.popleft()
+                result, batch_counters = async_result.get()
+                if counters is not None:
+                    counters['reads'] += len(result.loc)
+                    counters.update(batch_counters)
+                yield done_batch, result
+
+def alignReads(index, combined_ref, hash_length, read_batches, paired=False, max_candidates=16, stop_mismatches=-1, counters=None, cache_size=100000,
+               processes=1, index_file='', band=0):
+    '''
+    @param index: kmerindex.kmer_index of combined_ref
+    @param combined_ref: combined reference as a string or uint8 array
+    @param hash_length: k-mer length of index
+    @param read_batches: iterable of read batches as yielded by getReads
+    @param paired: True when each element of a batch is a (read1, read2) tuple
+    @param max_candidates, stop_mismatches, counters, band: see alignBatch
+    @param cache_size: number of distinct read sequences whose alignments are remembered across batches, 0 to only collapse duplicates within a batch
+    @param processes: number of processes to align batches in, each keeps its own cache
+    @param index_file: file index was loaded from, when aligning in more than one process and index is not from a file it is written to shared memory
+    @return: generator of (batch, alignment_result) with results in order of read1_1, read2_1, read1_2, read2_2... when paired
+    '''
+    import kmerindex
+    if processes > 1:
+        shared_file = ''
+        if not index_file:
+            import tempfile
+            #/dev/shm is memory backed, so mapping the index from it is mapping shared memory
+            fd, shared_file = tempfile.mkstemp(suffix=".idx", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+            os.close(fd)
+            index_file = shared_file
+            kmerindex.saveIndex(index, index_file)
+        try:
+            yield from alignReadsParallel(index_file, hash_length, read_batches, paired, processes, max_candidates, stop_mismatches, counters, cache_size, band)
+        finally:
+            if shared_file:
+                os.remove(shared_file)
+        return
+    ref_bytes = kmerindex.toBytes(combined_ref)
+    cache = AlignmentCache(cache_size) if cache_size > 0 else None
+    for batch in read_batches:
+        seqs = batchSeqs(batch, paired)
+        if counters is not None:
+            counters['reads'] += len(seqs)
+        yield batch, alignUnique(index, ref_bytes, seqs, hash_length, cache, max_candidates, stop_mismatches, counters, band)
+
+reference = namedtuple('reference', ['index', 'combined_ref', 'coords', 'index_file'])
+batch_hits = namedtuple('batch_hits', ['reads', 'read_bytes', 'read_lengths', 'result', 'place', 'mapped', 'edits'])
+
+def loadReference(run_metrics, ref_file, read_length, hash_length, index_file='', cache_dir='', window=0, max_occurrences=0):
+    '''
+    @param run_metrics: metrics.RunMetrics to record stage times in
+    @param ref_file: a path to reference file
+    @param read_length: longest read length that will be aligned, used as padding if the index has to be built
+    @param hash_length: k-mer length of the index, 0 to pick it automatically or take that of index_file
+    @param index_file: k-mer index file, loaded if it exists and written after building otherwise
+    @param cache_dir: directory of cached indexes, used when index_file is not given
+    @param window, max_occurrences: minimizer window and masking threshold, see hashReferences, window is checked against index_file unless 0
+    @return: reference with the index, combined_ref, ref_coords and index file (if any) to align against
+    '''
+    import kmerindex
+    #create index of combined reference sequence and way to decode positon meaning, reusing a saved index when given one
+    if not index_file and cache_dir:
+        index_file = kmerindex.cachedIndex(cache_dir, ref_file, hash_length, read_length,
+                                           lambda: hashReferences(ref_file, read_length, hash_length, run_metrics, window, max_occurrences)[0],
+                                           window, max_occurrences)
+    if index_file and os.path.exists(index_file):
+        with run_metrics.stage('loadIndex'):
+            index = kmerindex.loadIndex(index_file)
+        if (hash_length > 0 and index.hash_length != hash_length) or (window > 0 and index.window != window) or index.read_length < read_length:
+            raise ValueError("Index %s was built with hash length %d, window %d and padding %d, need hash length %d, window %d and padding of at least %d" % (
+                index_file, index.hash_length, index.window, index.read_length, hash_length, window, read_length))
+        coords = buildCoordinates(index.reference_locs)
+        combined_ref = index.combined_ref
+    else:
+        index, reference_locs, x_locs, combined_ref, coords = hashReferences(ref_file, read_length, hash_length, run_metrics, window, max_occurrences)
+        if index_file:
+            kmerindex.saveIndex(index, index_file)
+    logging.info("index of %d-mers, window %d: %d k-mers at %d positions, %d repetitive k-mers masked (more than %d positions)" % (
+        index.hash_length, index.window, len(index.kmers), len(index.positions), index.masked, index.max_occurrences))
+    return reference(index, combined_ref, coords, index_file)
+
+def describeBatch(ref, batch, paired, result):
+    '''
+    @param ref: reference as made by loadReference
+    @param batch, paired: batch of reads as yielded by getReads
+    @param result: alignment_result of batch as yielded by alignReads
+    @return: batch_hits for the writers of alignoutput, reads are the fastq_records in the order of result, place their placement as made
+             by resolveCoordinates, mapped marks the reads placed on a reference and edits maps the index of each read placed with an indel
+             to its editdistance.edit_alignment
+    '''
+    import numpy as np
+    import editdistance
+    reads = [read for pair in batch for read in pair] if paired else list(batch)
+    read_bytes, read_lengths = encodeReads([read.seq for read in reads])
+    place = resolveCoordinates(ref.coords, result.loc, result.loc + read_lengths)
+    mapped = (result.loc != -1) & (place.ref_id != -1)
+    edits = dict()
+    for i in np.flatnonzero(mapped & (result.cigar != '')).tolist():
+        edits[i] = editdistance.edit_alignment(int(result.loc[i]), int(result.diff[i]), int(result.aligned[i]), result.cigar[i])
+    return batch_hits(reads, read_bytes, read_lengths, result, place, mapped, edits)
+
+def peekReads(read_batches, paired):
+    '''
+    @param read_batches: iterator of read batches as yielded by getReads
+    @param paired: True when each element of a batch is a (read1, read2) tuple
+    @return read_length: longest read in the first batch, -1 if there are no reads
+    @return read_batches: iterator of all the read batches, including the first one
+    '''
+    first_batch = next(read_batches, [])
+    read_length = max([len(seq) for seq in batchSeqs(first_batch, paired)] or [-1])
+    #put the first batch back in front so alignment starts on it while later batches are still unread
+    return read_length, chain([first_batch], read_batches)
+
+def alignSample(run_metrics, ref, read_batches, paired, hash_length, max_candidates=16, stop_mismatches=-1, cache_size=100000, processes=1, band=0,
+                writers=()):
+    '''
+    @param run_metrics: metrics.RunMetrics to record stage times and counters of the run in, read_batches should be timed in its getReads stage
+    @param ref: reference as made by loadReference
+    @param read_batches, paired, hash_length, max_candidates, stop_mismatches, cache_size, processes, band: see alignReads
+    @param writers: writers made by alignoutput.openWriters, given the batch_hits of every batch and closed once all reads are aligned
+    @return: array of the number of reads placed on each reference, in order of ref.coords
+    '''
+    import numpy as np
+    coords = ref.coords
+    counters = run_metrics.counters
+    ref_counts = np.zeros(len(coords.names), dtype=np.int64)
+    #reads are loaded lazily inside the loop, so the time spent loading them is taken back out of the alignment time
+    read_seconds = run_metrics.stages.get('getReads', {}).get('wall_seconds', 0)
+    write_seconds = run_metrics.stages.get('writeOutput', {}).get('wall_seconds', 0)
+    align_start = time.time()
+    for batch, result in alignReads(ref.index, ref.combined_ref, hash_length, read_batches, paired,
+                                    max_candidates, stop_mismatches, counters, cache_size, processes, ref.index_file, band):
+        if writers:
+            with run_metrics.stage('writeOutput'):
+                hits = describeBatch(ref, batch, paired, result)
+                for writer in writers:
+                    writer.add(hits)
+            ref_ids = hits.place.ref_id[hits.mapped]
         else:
-            #can immedietely return because range_list is increasing
-            return present_range
-    return present_range
-
-def alignReads(hash_table, combined_ref, x_locs, hash_length, read_length, msa1, msa2 = None, ):
-    #paired alignment
-    if msa2 != None:
-        #for each read from a sample, do in order of read1_1, read2_1, read1_2, read2_2...
-        for read in iter(msa1):
-            #search every hash_length fragment of read in hash of references
-            str_read = str(read)
-            for i in range(read_length - hash_length):
-                sub_read = str_read[i:i + hash_length]
-                #check if the read is in the table
-                if sub_read in hash_table:
-                    #loop across the locations it was found in the reference
-                    for loc in hash_table[sub_read]:
-                        #where the complete read starts and ends
-                        read_start = loc - i
-                        read_end = read_start + read_length
-                        #check if read overlaps x's
-                        overlaps_start = in_range(x_locs, read_start, True)
-                        overlaps_end = in_range(x_locs, read_end, False)
-                        #trim locations where read hangs off ref (i.e. overlaps x's)
-                        if overlaps_start != []:
-                            overlap = overlaps_start[1] - overlaps_start[0]
-                            read = str_read[overlap: ]
-                            new_start = read_start + overlap
-                        else:
-                            new_start = read_start
-                        if overlaps_end != []:
-                            overlap = overlaps_end[1] - overlaps_end[0]
-                            read = str_read[: -overlap]
-                            new_end = read_end - overlap
+            read_starts = result.loc
+            read_ends = read_starts + np.array([len(seq) for seq in batchSeqs(batch, paired)], dtype=np.int64)
+            ref_ids = resolveCoordinates(coords, read_starts, read_ends).ref_id
+            ref_ids = ref_ids[(result.loc != -1) & (ref_ids != -1)]
+        counters['mapped'] += len(ref_ids)
+        ref_counts += np.bincount(ref_ids, minlength=len(coords.names))
+    #time spent describing and writing batches is taken out of the alignment time like the time spent loading them
+    read_seconds = run_metrics.stages.get('getReads', {}).get('wall_seconds', 0) - read_seconds
+    write_seconds = run_metrics.stages.get('writeOutput', {}).get('wall_seconds', 0) - write_seconds
+    with run_metrics.stage('writeOutput'):
+        for writer in writers:
+            writer.close()
+    run_metrics.addTime('alignReads', time.time() - align_start - read_seconds - write_seconds)
+    counters['unmapped'] = counters['reads'] - counters['mapped']
+    counters.update(dict(('reads_%s' % name, count) for name, count in zip(coords.names, ref_counts.tolist())))
+    #every seed hit beyond the first on a diagonal is a verification the per seed loop would have done
+    counters['skipped_duplicate_diagonals'] = counters['seed_hits'] - counters['diagonals']
+    logging.info("%d of %d reads had a placement" % (counters['mapped'], counters['reads']))
+    for name, count in zip(coords.names, ref_counts.tolist()):
+        logging.info("%s: %d reads" % (name, count))
+    logging.info("%d distinct read sequences, %d alignments served from cache" % (counters['unique_sequences'], counters['cache_hits']))
+    logging.info("seed lookups: %d, seed hits: %d, verified: %d, skipped as duplicate diagonals: %d, low votes: %d, early stop: %d" % (
+        counters['seed_lookups'], counters['seed_hits'], counters['verified'], counters['skipped_duplicate_diagonals'],
+        counters['skipped_low_votes'], counters['skipped_early_stop']))
+    if band > 0:
+        logging.info("realigned with edit distance: %d, placed by an indel: %d" % (counters['edit_verified'], counters['indel_rescued']))
+    return ref_counts
+
+def align(run_metrics, ref_file, read1_file, read2_file, hash_length, batch_size, max_candidates, stop_mismatches,
+          cache_size, processes, index_file, cache_dir, band=0, window=0, max_occurrences=0, out_dir='', outputs=()):
+    '''
+    @param run_metrics: metrics.RunMetrics to record stage times and counters of the run in
+    @param out_dir, outputs: directory to write and alignoutput.OUTPUT_FORMATS to write the alignments of the sample in
+    @return: array of the number of reads placed on each reference, in order of the ref_coords of the reference
+    '''
+    import alignoutput
+    #stream reads from fastq files in bounded size batches
+    read_batches = run_metrics.timed('getReads', getReads(read1_file, read2_file, batch_size))
+    #get the read length from the first batch for use in creating reference hash
+    read_length, read_batches = peekReads(read_batches, read2_file != '')
+    ref = loadReference(run_metrics, ref_file, read_length, hash_length, index_file, cache_dir, window, max_occurrences)
+    writers = alignoutput.openWriters(outputs, out_dir or os.getcwd(), run_metrics.sample, ref, read2_file != '')
+    return alignSample(run_metrics, ref, read_batches, read2_file != '', ref.index.hash_length, max_candidates, stop_mismatches, cache_size, processes, band,
+                       writers)
+
+def runJob(job, ref, batch_size, max_candidates, stop_mismatches, cache_size, processes, band=0, outputs=()):
+    '''
+    @param job: dictionary with the sample name, r1 and r2 read files and out_dir of a sample, as sent by alignclient.submitSample,
+                and optionally the first_read and last_read of the shard of the sample to align, as read by readManifest
+    @param ref: reference as made by loadReference
+    @param outputs: alignoutput.OUTPUT_FORMATS to write the alignments of the sample in
+    @return: path of the metrics file written for the sample, or for the shard while other shards of the sample are unfinished
+    '''
+    import alignoutput
+    sample = job['sample']
+    out_dir = job.get('out_dir') or os.getcwd()
+    read2_file = job.get('r2') or ''
+    n_shards = job.get('n_shards', 1)
+    name = metrics.shardName(sample, job.get('shard', 0), n_shards)
+    #give each sample its own log file, as a separate aligner.py run would have
+    handler = logging.FileHandler(os.path.join(out_dir, "%s_log.out" % name), 'w')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s', '%m/%d/%Y %H:%M:%S'))
+    logging.getLogger().addHandler(handler)
+    try:
+        run_metrics = metrics.RunMetrics(name)
+        read_batches = run_metrics.timed('getReads', getReads(job['r1'], read2_file, batch_size, job.get('first_read', 0), job.get('last_read', -1)))
+        read_length, read_batches = peekReads(read_batches, read2_file != '')
+        if read_length > ref.index.read_length:
+            raise ValueError("Reads of %d bases are longer than the %d base padding of the loaded index" % (read_length, ref.index.read_length))
+        writers = alignoutput.openWriters(outputs, out_dir, name, ref, read2_file != '', job.get('first_read', 0))
+        alignSample(run_metrics, ref, read_batches, read2_file != '', ref.index.hash_length, max_candidates, stop_mismatches, cache_size, processes, band,
+                    writers)
+        metrics_file = os.path.join(out_dir, "%s_metrics.json" % name)
+        run_metrics.write(metrics_file)
+        if n_shards > 1:
+            #the last shard of the sample to finish merges the outputs of all of them
+            merged_file = metrics.mergeShards(out_dir, sample, n_shards)
+            if merged_file:
+                alignoutput.mergeOutputs(out_dir, sample, n_shards, outputs)
+            return merged_file or metrics_file
+        return metrics_file
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+def arrayTaskId():
+    '''
+    @return: task id of this array job task as set by SLURM, PBS or SGE, None outside an array job
+    '''
+    for variable in ['SLURM_ARRAY_TASK_ID', 'PBS_ARRAY_INDEX', 'PBS_ARRAYID', 'SGE_TASK_ID']:
+        task = os.environ.get(variable)
+        #SGE sets SGE_TASK_ID to undefined for jobs that are not arrays
+        if task and task.isdigit():
+            return int(task)
+    return None
+
+def readManifest(manifest_file, task):
+    '''
+    @param manifest_file: tab separated sample manifest as written by dispatcher.writeManifest
+    @param task: array task whose samples to return
+    @return: list of job dictionaries with the sample name, r1 and r2 read files, read range and shard of each sample in task, as taken by runJob
+    '''
+    jobs = []
+    with open(manifest_file) as manifest:
+        for line in manifest:
+            fields = line.rstrip('\n').split('\t')
+            if int(fields[0]) == task:
+                job = {'sample': fields[1], 'r1': fields[2], 'r2': fields[3]}
+                #manifests written before samples were sharded only have the first four columns
+                if len(fields) > 4:
+                    job.update(zip(['first_read', 'last_read', 'shard', 'n_shards'], [int(field) for field in fields[4:8]]))
+                jobs.append(job)
+    return jobs
+
+def runTask(jobs, ref, out_dir, batch_size, max_candidates, stop_mismatches, cache_size, processes, band=0, outputs=()):
+    '''
+    @param jobs: job dictionaries of the samples packed into one array task, as returned by readManifest
+    @param ref: reference as made by loadReference, shared by every sample of the task
+    @return: list of the samples that failed, the others still get aligned when one fails
+    '''
+    failed = []
+    for job in jobs:
+        job['out_dir'] = out_dir
+        try:
+            runJob(job, ref, batch_size, max_candidates, stop_mismatches, cache_size, processes, band, outputs)
+        except Exception:
+            name = metrics.shardName(job['sample'], job.get('shard', 0), job.get('n_shards', 1))
+            logging.exception("alignment of %s failed" % name)
+            failed.append(name)
+    return failed
+
+def serve(socket_path, ref, batch_size, max_candidates, stop_mismatches, cache_size, processes, band=0, outputs=()):
+    '''
+    @param socket_path: path of the unix socket to accept jobs on
+    @param ref: reference as made by loadReference, loaded once and used for every job
+    runs until a shutdown message is received, see alignclient for the messages understood
+    '''
+    import json
+    import queue
+    import socket
+    import threading
+    jobs = queue.Queue()
+    states = dict()
+    changed = threading.Condition()
+    stopping = threading.Event()
+    def setState(jobid, **state):
+        with changed:
+            states[jobid].update(state)
+            changed.notify_all()
+    def work():
+        while True:
+            jobid = jobs.get()
+            if jobid is None:
+                break
+            setState(jobid, state='running')
+            try:
+                metrics_file = runJob(states[jobid]['job'], ref, batch_size, max_candidates, stop_mismatches, cache_size, processes, band, outputs)
+                setState(jobid, state='done', metrics=metrics_file)
+            except Exception as e:
+                logging.exception("job %s failed" % jobid)
+                setState(jobid, state='failed', error=repr(e))
+        stopping.set()
+    def handle(connection):
+        with connection, connection.makefile('rw') as stream:
+            for line in stream:
+                message = json.loads(line)
+                command = message.get('command')
+                if command == 'submit':
+                    with changed:
+                        jobid = str(len(states) + 1)
+                        states[jobid] = {'state': 'queued', 'job': message['job']}
+                    jobs.put(jobid)
+                    logging.info("queued job %s: %s" % (jobid, message['job']))
+                    reply = {'jobid': jobid, 'state': 'queued'}
+                elif command in ('status', 'wait'):
+                    with changed:
+                        if message['jobid'] not in states:
+                            reply = {'error': "unknown job %s" % message['jobid']}
                         else:
-                            new_end = read_end
-                        #align the non-trimmed region
-                        diff = 0
-                        for base in range(new_start, new_end):
-                            if combined_ref[base] != str_read[base-new_start]:
-                                diff += 1
-    #not paired alignment
-    else:
-        pass
-    return
+                            if command == 'wait':
+                                changed.wait_for(lambda: states[message['jobid']]['state'] in ('done', 'failed'))
+                            reply = dict((key, value) for key, value in states[message['jobid']].items() if key != 'job')
+                elif command == 'shutdown':
+                    #queued jobs are finished first unless told to stop now
+                    if message.get('when') == 'now':
+                        with jobs.mutex:
+                            jobs.queue.clear()
+                    jobs.put(None)
+                    reply = {'state': 'stopping'}
+                else:
+                    reply = {'error': "unknown command %s" % command}
+                stream.write(json.dumps(reply) + "\n")
+                stream.flush()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(64)
+    server.settimeout(1.0)
+    worker = threading.Thread(target=work)
+    worker.start()
+    logging.info("serving on %s" % socket_path)
+    try:
+        while not stopping.is_set():
+            try:
+                connection, address = server.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            threading.Thread(target=handle, args=(connection, ), daemon=True).start()
+    finally:
+        server.close()
+        os.remove(socket_path)
+        jobs.put(None)
+        worker.join()
+    logging.info("server on %s stopped" % socket_path)
 
 def main():
     parser = argparse.ArgumentParser()
     required_group = parser.add_argument_group("required arguments")
-    required_group.add_argument("-s", "--sample", dest="sample", required=True, help="name of read file(s) sample")
-    required_group.add_argument("-r1", "--read_file1", dest="r1", required=True, help="read file of read1s to be aligned")
+    required_group.add_argument("-s", "--sample", dest="sample", help="name of read file(s) sample [REQUIRED unless --serve]")
+    required_group.add_argument("-r1", "--read_file1", dest="r1", help="read file of read1s to be aligned [REQUIRED unless --serve]")
     required_group.add_argument("-f", "--reference-fasta", dest="ref", required=True, help="fasta describing reference sequences")
     required_group.add_argument("-o", "--out-dir", dest="odir", metavar="DIR", help="directory to write output files to.")
     #required_group.add_argument("--function", dest="function", required=True, help="which function to run")
     optional_group = parser.add_argument_group("optional arguments")
     optional_group.add_argument("-r2", "--read_file2", dest="r2", required=False, default='', help="read file of read2s to be aligned [default: '']")
     optional_group.add_argument("-j", "--job_manager", dest="job_manager", default="SLURM", help="cluster job submitter to use (PBS, SLURM, SGE, none). [default: SLURM]")
-    optional_group.add_argument("--hash-length", dest="hash_length", type=int, required=False, default=5, help="reference subsequence length")
+    optional_group.add_argument("--hash-length", dest="hash_length", type=int, required=False, default=0, help="reference subsequence length, 0 to pick it from the size of the references and the read length [default: 0]")
+    optional_group.add_argument("--window", dest="window", type=int, required=False, default=0, help="only index and seed with the minimizer of every WINDOW consecutive subsequences, 0 to pick it from the hash length, 1 to use every subsequence [default: 0]")
+    optional_group.add_argument("--max-occurrences", dest="max_occurrences", type=int, required=False, default=0, help="leave subsequences found at more places in the references out of the index, 0 to pick the threshold from their counts, -1 to keep all [default: 0]")
+    optional_group.add_argument("--batch-size", dest="batch_size", type=int, required=False, default=10000, help="number of reads (or read pairs) held in memory at once [default: 10000]")
+    optional_group.add_argument("--max-candidates", dest="max_candidates", type=int, required=False, default=16, help="number of most seed voted diagonals verified per read, 0 for all [default: 16]")
+    optional_group.add_argument("--stop-mismatches", dest="stop_mismatches", type=int, required=False, default=-1, help="stop verifying a read once a placement with at most this many mismatched or overhanging bases is found, -1 to only stop on a unique perfect hit [default: -1]")
+    optional_group.add_argument("--band", dest="band", type=int, required=False, default=0, help="also verify candidates that are not perfect hits by banded edit distance, allowing indels that shift a read up to BAND bases, 0 for mismatches only [default: 0]")
+    optional_group.add_argument("--cache-size", dest="cache_size", type=int, required=False, default=100000, help="number of distinct read sequences whose alignments are remembered across batches [default: 100000]")
+    optional_group.add_argument("-p", "--processes", "--threads", dest="processes", type=int, required=False, default=1, help="number of processes to align reads with [default: 1]")
+    optional_group.add_argument("--output", dest="output", required=False, default="coverage", help="comma separated outputs to write to OUT_DIR: sam (SAMPLE.sam), binary (fixed width records in SAMPLE.records), coverage (reads, coverage and mismatches per reference position in SAMPLE_coverage.npz), or none, a sample aligned in shards writes them per shard and the last shard to finish merges them into the sample's files [default: coverage]")
+    optional_group.add_argument("--profile", dest="profile", action="store_true", help="profile the run with cProfile, stats are written to OUT_DIR/SAMPLE.prof")
+    optional_group.add_argument("--index", dest="index", required=False, default='', help="k-mer index file of the reference, loaded if it exists and written after building otherwise [default: '']")
+    optional_group.add_argument("--cache-dir", dest="cache_dir", required=False, default='', help="directory of k-mer indexes shared between jobs, used when --index is not given [default: '']")
+    array_group = parser.add_argument_group("array job arguments")
+    array_group.add_argument("--manifest", dest="manifest", required=False, default='', help="sample manifest written by dispatcher.startArrayAlignment, align the samples of one task of it instead of -s/-r1/-r2")
+    array_group.add_argument("--task", dest="task", type=int, required=False, help="task of the manifest to align [default: array task id set by the job manager]")
+    server_group = parser.add_argument_group("server arguments")
+    server_group.add_argument("--serve", dest="serve", metavar="SOCKET", required=False, default='', help="load the reference once and align samples submitted with alignclient over unix socket SOCKET until shut down")
+    server_group.add_argument("--read-length", dest="read_length", type=int, required=False, default=0, help="longest read --serve or --manifest will align, used as padding when the index has to be built [default: padding of --index, or 301]")
     args = parser.parse_args()
     sample = args.sample
     read1_file = args.r1
@@ -153,22 +916,65 @@ def main():
     job_manager = args.job_manager
     out_dir = args.odir
     hash_length = args.hash_length
-    #get reads from fastq files into skbio multiple sequence alignment objects
-    if read2_file != '':
-        msa1, msa2 = getReads(read1_file, read2_file)
-    else:
-        msa1 = getReads(read1_file)
-    #get the read length for use in creating reference hash
-    read_length = -1
-    for seq in iter(msa1):
-        read_length = len(seq)
-    #create hash table of combined reference sequence and way to decode positon meaning
-    hash_table, reference_locs, x_locs, combined_ref = hashReferences(ref_file, read_length, hash_length)
-    logging.debug("hashed")
-    alignReads(hash_table, combined_ref, x_locs, hash_length, read_length, msa1, msa2)
+    window = args.window
+    max_occurrences = args.max_occurrences
+    batch_size = args.batch_size
+    max_candidates = args.max_candidates
+    stop_mismatches = args.stop_mismatches
+    cache_size = args.cache_size
+    band = args.band
+    processes = args.processes
+    index_file = args.index
+    cache_dir = args.cache_dir
+    profile = args.profile
+    #same formats as alignoutput.OUTPUT_FORMATS, checked here so bad arguments fail before alignoutput loads numpy
+    output_formats = ('sam', 'binary', 'coverage')
+    outputs = [output for output in args.output.split(",") if output and output != "none"]
+    unknown = [output for output in outputs if output not in output_formats]
+    if unknown:
+        parser.error("unknown --output %s, expected a comma separated list of %s or none" % (", ".join(unknown), ", ".join(output_formats)))
+    if not args.serve and not args.manifest and (not sample or not read1_file):
+        parser.error("-s/--sample and -r1/--read_file1 are required unless --serve or --manifest is given")
+    task = args.task
+    if args.manifest:
+        if task is None:
+            task = arrayTaskId()
+        if task is None:
+            parser.error("--manifest needs --task outside an array job")
+        sample = "%s_task%d" % (os.path.splitext(os.path.basename(args.manifest))[0], task)
+    read_length = args.read_length
+    if not read_length:
+        #an existing index is checked against the length of each sample's reads instead
+        read_length = -1 if index_file and os.path.exists(index_file) else 301
+    if not out_dir:
+        out_dir = os.getcwd()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        filename=os.path.join(out_dir, "%s_log.out" % (sample or "server")),
+                        filemode='w')
+    if args.serve:
+        ref = loadReference(metrics.RunMetrics(None), ref_file, read_length, hash_length, index_file, cache_dir, window, max_occurrences)
+        serve(args.serve, ref, batch_size, max_candidates, stop_mismatches, cache_size, processes, band, outputs)
+        return
+    if args.manifest:
+        #load the index once for every sample packed into this task
+        jobs = readManifest(args.manifest, task)
+        logging.info("task %d of %s aligns %d samples" % (task, args.manifest, len(jobs)))
+        with metrics.profiled(os.path.join(out_dir, "%s.prof" % sample), profile):
+            ref = loadReference(metrics.RunMetrics(None), ref_file, read_length, hash_length, index_file, cache_dir, window, max_occurrences)
+            failed = runTask(jobs, ref, out_dir, batch_size, max_candidates, stop_mismatches, cache_size, processes, band, outputs)
+        if failed:
+            logging.error("%d of %d samples failed: %s" % (len(failed), len(jobs), ", ".join(failed)))
+            sys.exit(1)
+        logging.debug("finished")
+        return
+    run_metrics = metrics.RunMetrics(sample)
+    with metrics.profiled(os.path.join(out_dir, "%s.prof" % sample), profile):
+        align(run_metrics, ref_file, read1_file, read2_file, hash_length, batch_size, max_candidates, stop_mismatches,
+              cache_size, processes, index_file, cache_dir, band, window, max_occurrences, out_dir, outputs)
+    run_metrics.write(os.path.join(out_dir, "%s_metrics.json" % sample))
     logging.debug("finished")
-    output_log = os.open(os.path.join(out_dir, "%s_log.out" % sample), os.O_WRONLY | os.O_CREAT)
-
 
 
 if __name__ == '__main__':
@@ -0,0 +1,418 @@
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+'''
+output of aligner.py runs
+
+records are one line of sam text or one fixed width binary record per read, built a batch at a time and written to the
+file in large chunks. coverage keeps the reads placed on each reference and the coverage and mismatches at each of its
+positions in numpy arrays for the whole run, written once to <sample>_coverage.npz when the run ends, so memory grows
+with the references rather than with the depth of the sample.
+
+binary record file layout (all integers little endian):
+    magic (8 bytes) | version (uint32) | header length (uint32) | json header | padding to 8 bytes | records
+the json header records the reference names and lengths, whether reads were paired and the record dtype, readRecords
+loads the records as a numpy structured array.
+
+a sample split into shards is written one file per shard, and mergeOutputs joins them into the files of the sample once
+every shard has finished. read numbers in records are already numbers in the whole sample, so shards are simply put
+one after another.
+'''
+
+RECORD_MAGIC = b'AARECORD'
+RECORD_VERSION = 1
+OUTPUT_FORMATS = ('sam', 'binary', 'coverage')
+
+#read is the number of the read in its fastq file (of the read pair when paired), start and end are local to reference ref_id
+record_dtype = np.dtype([('read', '<u8'), ('ref_id', '<i4'), ('start', '<i4'), ('end', '<i4'), ('clip_left', '<u2'), ('clip_right', '<u2'),
+                         ('diff', '<u2'), ('n_best', '<u2'), ('flag', '<u2')])
+
+#sam flags
+PAIRED = 0x1
+UNMAPPED = 0x4
+MATE_UNMAPPED = 0x8
+FIRST_MATE = 0x40
+SECOND_MATE = 0x80
+
+def samFlags(mapped, paired):
+    '''
+    @param mapped: bool array marking the reads placed on a reference, mates next to each other when paired
+    @param paired: True when reads are read1, read2 of each pair in turn
+    @return: array of the sam flag of each read
+    '''
+    flags = np.where(mapped, 0, UNMAPPED)
+    if paired:
+        mate = np.arange(len(mapped)) ^ 1
+        flags |= PAIRED | np.where(np.arange(len(mapped)) % 2 == 0, FIRST_MATE, SECOND_MATE) | np.where(mapped[mate], 0, MATE_UNMAPPED)
+    return flags
+
+def refSpans(hits, coords):
+    '''
+    @param hits: aligner.batch_hits of a batch
+    @param coords: ref_coords of the reference the batch was aligned to
+    @return start, end: position in combined_ref of the first and past the last reference base each read is aligned to,
+                        taking the indels of reads placed by edit distance into account
+    '''
+    ref_start = coords.starts[hits.place.ref_id]
+    start = ref_start + hits.place.start
+    end = ref_start + hits.place.end
+    for i, edit in hits.edits.items():
+        ops = re.findall(r'(\d+)([MIDS])', edit.cigar)
+        clipped = int(ops[0][0]) if ops[0][1] == 'S' else 0
+        start[i] = edit.loc + clipped
+        end[i] = start[i] + sum(int(length) for length, op in ops if op in 'MD')
+    return start, end
+
+class SamWriter(object):
+    '''Sam text of each read, buffered and written a chunk at a time.'''
+    def __init__(self, path, coords, paired, chunk_size=1 << 22):
+        self.path = path
+        self.coords = coords
+        self.paired = paired
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        self.file = open(path, 'w')
+        header = ["@HD\tVN:1.6\tSO:unsorted"]
+        header.extend("@SQ\tSN:%s\tLN:%d" % (name, end - start) for name, start, end in zip(coords.names, coords.starts.tolist(), coords.ends.tolist()))
+        header.append("@PG\tID:amplicon_aligner\tPN:aligner.py")
+        self.file.write("\n".join(header) + "\n")
+    def add(self, hits):
+        '''
+        @param hits: aligner.batch_hits of the next batch
+        '''
+        coords = self.coords
+        mapped = hits.mapped
+        flags = samFlags(mapped, self.paired).tolist()
+        ref_id = hits.place.ref_id.tolist()
+        start, end = refSpans(hits, coords)
+        pos = np.where(mapped, start - coords.starts[hits.place.ref_id] + 1, 0).tolist()
+        end = np.where(mapped, end - coords.starts[hits.place.ref_id], 0).tolist()
+        clip_left, clip_right = hits.place.clip_left.tolist(), hits.place.clip_right.tolist()
+        diff, n_best = hits.result.diff.tolist(), hits.result.n_best.tolist()
+        lines = []
+        for i, read in enumerate(hits.reads):
+            name = read.name.split()[0]
+            if self.paired and name[-2:] in ('/1', '/2'):
+                name = name[:-2]
+            if not mapped[i]:
+                rname, cigar, mapq = '*', '*', 0
+            else:
+                rname = coords.names[ref_id[i]]
+                mapq = 60 if n_best[i] == 1 else 0
+                if i in hits.edits:
+                    cigar = hits.edits[i].cigar
+                else:
+                    cigar = ''.join("%d%s" % (length, op) for length, op in
+                                    ((clip_left[i], 'S'), (end[i] - pos[i] + 1, 'M'), (clip_right[i], 'S')) if length)
+            rnext, pnext, tlen = '*', 0, 0
+            if self.paired:
+                mate = i ^ 1
+                if mapped[mate]:
+                    rnext = '=' if mapped[i] and ref_id[mate] == ref_id[i] else coords.names[ref_id[mate]]
+                    pnext = pos[mate]
+                    if rnext == '=':
+                        #template length is positive for the leftmost mate
+                        span = max(end[i], end[mate]) - min(pos[i], pos[mate]) + 1
+                        tlen = span if (pos[i], i) < (pos[mate], mate) else -span
+            fields = [name, str(flags[i]), rname, str(pos[i]), str(mapq), cigar, rnext, str(pnext), str(tlen), read.seq, read.qual]
+            if mapped[i]:
+                fields.append("NM:i:%d" % diff[i])
+            lines.append("\t".join(fields))
+        self.buffer.append("\n".join(lines) + "\n" if lines else "")
+        self.buffered += sum(len(line) + 1 for line in lines)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+    def flush(self):
+        self.file.write("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+    def close(self):
+        self.flush()
+        self.file.close()
+        logging.info("wrote alignments to %s" % self.path)
+
+class BinaryWriter(object):
+    '''Fixed width record_dtype record of each read, buffered and written a chunk at a time.'''
+    def __init__(self, path, coords, paired, first_read=0, chunk_size=1 << 22):
+        self.path = path
+        self.coords = coords
+        self.paired = paired
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        self.first_read = first_read
+        self.n_reads = 0
+        self.file = open(path, 'wb')
+        header = {'names': coords.names, 'lengths': (coords.ends - coords.starts).tolist(), 'paired': paired,
+                  'dtype': [list(field) for field in record_dtype.descr]}
+        header_bytes = json.dumps(header).encode('utf-8')
+        self.file.write(RECORD_MAGIC)
+        self.file.write(np.array([RECORD_VERSION, len(header_bytes)], dtype='<u4').tobytes())
+        self.file.write(header_bytes)
+        self.file.write(b'\0' * (-(len(RECORD_MAGIC) + 8 + len(header_bytes)) % 8))
+    def add(self, hits):
+        '''
+        @param hits: aligner.batch_hits of the next batch
+        '''
+        records = np.zeros(len(hits.reads), dtype=record_dtype)
+        #mates share the number of their pair
+        records['read'] = self.first_read + self.n_reads + (np.arange(len(records)) // 2 if self.paired else np.arange(len(records)))
+        self.n_reads += len(records) // 2 if self.paired else len(records)
+        start, end = refSpans(hits, self.coords)
+        ref_start = self.coords.starts[hits.place.ref_id]
+        records['ref_id'] = np.where(hits.mapped, hits.place.ref_id, -1)
+        records['start'] = np.where(hits.mapped, start - ref_start, 0)
+        records['end'] = np.where(hits.mapped, end - ref_start, 0)
+        records['clip_left'] = np.where(hits.mapped, hits.place.clip_left, 0)
+        records['clip_right'] = np.where(hits.mapped, hits.place.clip_right, 0)
+        records['diff'] = np.where(hits.mapped, hits.result.diff, 0)
+        records['n_best'] = hits.result.n_best
+        records['flag'] = samFlags(hits.mapped, self.paired)
+        self.buffer.append(records.tobytes())
+        self.buffered += records.nbytes
+        if self.buffered >= self.chunk_size:
+            self.flush()
+    def flush(self):
+        self.file.write(b''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+    def close(self):
+        self.flush()
+        self.file.close()
+        logging.info("wrote %d records to %s" % (self.n_reads, self.path))
+
+def readRecordHeader(f, path):
+    '''
+    @param f: record file written by BinaryWriter, opened for binary reading at its start
+    @param path: name of the file for error messages
+    @return header: dictionary with the reference names and lengths, whether reads were paired and the record dtype
+    @return data_start: offset of the first record in the file
+    '''
+    if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+        raise ValueError("%s is not a record file" % path)
+    version, header_length = np.frombuffer(f.read(8), dtype='<u4')
+    if version != RECORD_VERSION:
+        raise ValueError("%s is a version %d record file, expected version %d" % (path, version, RECORD_VERSION))
+    header = json.loads(f.read(int(header_length)).decode('utf-8'))
+    return header, -(-(len(RECORD_MAGIC) + 8 + int(header_length)) // 8) * 8
+
+def readRecords(path):
+    '''
+    @param path: record file written by BinaryWriter
+    @return header: dictionary with the reference names and lengths and whether reads were paired
+    @return records: read-only memory map of the records as a record_dtype array
+    '''
+    with open(path, 'rb') as f:
+        header, data_start = readRecordHeader(f, path)
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    n_records = (os.path.getsize(path) - data_start) // dtype.itemsize
+    if n_records == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=data_start, shape=(n_records, ))
+
+class CoverageAggregator(object):
+    '''Reads placed on each reference and coverage and mismatches at each of its positions, summed over a run.'''
+    def __init__(self, path, coords, ref_bytes):
+        self.path = path
+        self.coords = coords
+        self.ref_bytes = ref_bytes
+        self.reads = np.zeros(len(coords.names), dtype=np.int64)
+        #coverage is kept as its differences along combined_ref, each read adds two entries instead of one per base
+        self.coverage_delta = np.zeros(len(ref_bytes) + 1, dtype=np.int64)
+        self.mismatches = np.zeros(len(ref_bytes), dtype=np.int64)
+    def add(self, hits):
+        '''
+        @param hits: aligner.batch_hits of the next batch
+        '''
+        mapped = np.flatnonzero(hits.mapped)
+        self.reads += np.bincount(hits.place.ref_id[mapped], minlength=len(self.reads))
+        start, end = refSpans(hits, self.coords)
+        np.add.at(self.coverage_delta, start[mapped], 1)
+        np.add.at(self.coverage_delta, end[mapped], -1)
+        #reads placed along their diagonal are compared base by base in one numpy pass
+        diagonal = mapped[[i not in hits.edits for i in mapped.tolist()]]
+        cols = np.arange(hits.read_bytes.shape[1])
+        ref_pos = hits.result.loc[diagonal, None] + cols
+        in_ref = (ref_pos >= start[diagonal, None]) & (ref_pos < end[diagonal, None]) & (hits.read_bytes[diagonal] != 0)
+        ref_window = self.ref_bytes[np.clip(ref_pos, 0, len(self.ref_bytes) - 1)]
+        np.add.at(self.mismatches, ref_pos[in_ref & (ref_window != hits.read_bytes[diagonal])], 1)
+        #reads placed with indels walk their cigar, a deleted base or a base inserted before a position counts as a mismatch there
+        for i, edit in hits.edits.items():
+            seq = hits.reads[i].seq
+            ref_pos, read_pos = start[i], 0
+            for length, op in re.findall(r'(\d+)([MIDS])', edit.cigar):
+                length = int(length)
+                if op == 'M':
+                    read = np.frombuffer(seq[read_pos:read_pos + length].encode('ascii'), dtype=np.uint8)
+                    np.add.at(self.mismatches, ref_pos + np.flatnonzero(self.ref_bytes[ref_pos:ref_pos + length] != read), 1)
+                    ref_pos += length
+                    read_pos += length
+                elif op == 'D':
+                    self.mismatches[ref_pos:ref_pos + length] += 1
+                    ref_pos += length
+                else:
+                    if op == 'I' and ref_pos < len(self.mismatches):
+                        self.mismatches[ref_pos] += 1
+                    read_pos += length
+    def close(self):
+        coverage = np.cumsum(self.coverage_delta[:-1])
+        writeCoverage(self.path, self.coords.names, self.coords.ends - self.coords.starts, self.reads,
+                      np.concatenate([coverage[start:end] for start, end in zip(self.coords.starts, self.coords.ends)] or [np.zeros(0, dtype=np.int64)]),
+                      np.concatenate([self.mismatches[start:end] for start, end in zip(self.coords.starts, self.coords.ends)] or [np.zeros(0, dtype=np.int64)]))
+        logging.info("wrote coverage of %d references to %s" % (len(self.reads), self.path))
+
+def writeCoverage(path, names, lengths, reads, coverage, mismatches):
+    '''
+    @param path: file to write, written to a temporary file first so a partial file is never left behind
+    @param names, lengths, reads: name, length and number of reads placed of each reference
+    @param coverage, mismatches: per position arrays of every reference one after another, reference i is
+                                 [offsets[i]:offsets[i + 1]] with offsets the running sum of lengths
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tmp_path = "%s.tmp%d.npz" % (path, os.getpid())
+    np.savez_compressed(tmp_path, names=np.array(names, dtype=str), lengths=lengths, offsets=offsets, reads=reads,
+                        coverage=coverage, mismatches=mismatches)
+    os.replace(tmp_path, path)
+
+def readCoverage(path):
+    '''
+    @param path: coverage file written by CoverageAggregator
+    @return: dictionary of reference name to its reads placed and coverage and mismatch arrays
+    '''
+    with np.load(path) as data:
+        offsets = data['offsets']
+        return dict((name, {'reads': int(data['reads'][i]), 'coverage': data['coverage'][offsets[i]:offsets[i + 1]],
+                            'mismatches': data['mismatches'][offsets[i]:offsets[i + 1]]})
+                    for i, name in enumerate(data['names'].tolist()))
+
+def coveragePath(out_dir, name):
+    return os.path.join(out_dir, "%s_coverage.npz" % name)
+
+def samPath(out_dir, name):
+    return os.path.join(out_dir, "%s.sam" % name)
+
+def recordsPath(out_dir, name):
+    return os.path.join(out_dir, "%s.records" % name)
+
+def openWriters(outputs, out_dir, name, ref, paired, first_read=0):
+    '''
+    @param outputs: formats to write, from OUTPUT_FORMATS
+    @param out_dir: directory to write them to
+    @param name: sample (or shard) name the files are named by
+    @param ref: aligner.reference the sample is aligned to
+    @param paired: True when reads are paired
+    @param first_read: number of the first read aligned, when only a shard of the sample's reads is
+    @return: list of writers, each with an add method taking the aligner.batch_hits of every batch and a close method
+    '''
+    import kmerindex
+    writers = []
+    for output in outputs:
+        if output == 'sam':
+            writers.append(SamWriter(samPath(out_dir, name), ref.coords, paired))
+        elif output == 'binary':
+            writers.append(BinaryWriter(recordsPath(out_dir, name), ref.coords, paired, first_read))
+        elif output == 'coverage':
+            writers.append(CoverageAggregator(coveragePath(out_dir, name), ref.coords, kmerindex.toBytes(ref.combined_ref)))
+        else:
+            raise ValueError("unknown output %s, expected one of %s" % (output, ", ".join(OUTPUT_FORMATS)))
+    return writers
+
+def mergeCoverage(out_dir, sample, n_shards):
+    '''
+    @param out_dir: directory the shards of sample wrote their coverage files to
+    @param sample: sample that was split into n_shards read ranges
+    @return: path of the coverage file summing every shard, None if some shards wrote no coverage
+    '''
+    import metrics
+    shard_files = [coveragePath(out_dir, metrics.shardName(sample, shard, n_shards)) for shard in range(n_shards)]
+    if not all(os.path.exists(shard_file) for shard_file in shard_files):
+        return None
+    merged = None
+    for shard_file in shard_files:
+        with np.load(shard_file) as data:
+            shard = dict((key, data[key]) for key in data.files)
+        if merged is None:
+            merged = shard
+        else:
+            for key in ('reads', 'coverage', 'mismatches'):
+                merged[key] = merged[key] + shard[key]
+    merged_file = coveragePath(out_dir, sample)
+    writeCoverage(merged_file, merged['names'], merged['lengths'], merged['reads'], merged['coverage'], merged['mismatches'])
+    logging.info("merged coverage of %d shards of %s into %s" % (n_shards, sample, merged_file))
+    return merged_file
+
+def mergeSam(out_dir, sample, n_shards):
+    '''
+    @param out_dir: directory the shards of sample wrote their sam files to
+    @param sample: sample that was split into n_shards read ranges
+    @return: path of the sam file with the header of the first shard and the alignments of every shard in shard order, None if some shards wrote no sam
+    '''
+    import shutil
+    import metrics
+    shard_files = [samPath(out_dir, metrics.shardName(sample, shard, n_shards)) for shard in range(n_shards)]
+    if not all(os.path.exists(shard_file) for shard_file in shard_files):
+        return None
+    merged_file = samPath(out_dir, sample)
+    tmp_path = "%s.tmp%d" % (merged_file, os.getpid())
+    with open(tmp_path, 'wb') as merged:
+        for shard, shard_file in enumerate(shard_files):
+            with open(shard_file, 'rb') as f:
+                #every shard has the same header, so only the first one's is kept
+                for line in f:
+                    if line[:1] != b'@':
+                        merged.write(line)
+                        break
+                    if shard == 0:
+                        merged.write(line)
+                shutil.copyfileobj(f, merged, 1 << 22)
+    os.replace(tmp_path, merged_file)
+    logging.info("merged alignments of %d shards of %s into %s" % (n_shards, sample, merged_file))
+    return merged_file
+
+def mergeRecords(out_dir, sample, n_shards):
+    '''
+    @param out_dir: directory the shards of sample wrote their record files to
+    @param sample: sample that was split into n_shards read ranges
+    @return: path of the record file with the records of every shard in shard order, None if some shards wrote no records
+    '''
+    import shutil
+    import metrics
+    shard_files = [recordsPath(out_dir, metrics.shardName(sample, shard, n_shards)) for shard in range(n_shards)]
+    if not all(os.path.exists(shard_file) for shard_file in shard_files):
+        return None
+    merged_file = recordsPath(out_dir, sample)
+    tmp_path = "%s.tmp%d" % (merged_file, os.getpid())
+    first_header = None
+    with open(tmp_path, 'wb') as merged:
+        for shard_file in shard_files:
+            with open(shard_file, 'rb') as f:
+                header, data_start = readRecordHeader(f, shard_file)
+                if first_header is None:
+                    first_header = header
+                    f.seek(0)
+                elif header != first_header:
+                    raise ValueError("%s was written against other references or read layout than the first shard of %s" % (shard_file, sample))
+                else:
+                    f.seek(data_start)
+                shutil.copyfileobj(f, merged, 1 << 22)
+    os.replace(tmp_path, merged_file)
+    logging.info("merged records of %d shards of %s into %s" % (n_shards, sample, merged_file))
+    return merged_file
+
+def mergeOutputs(out_dir, sample, n_shards, outputs=OUTPUT_FORMATS):
+    '''
+    @param out_dir: directory the shards of sample wrote their output files to
+    @param sample: sample that was split into n_shards read ranges, run once every shard has finished
+    @param outputs: formats to merge, from OUTPUT_FORMATS, formats some shard did not write are skipped
+    @return: list of the merged files
+    '''
+    merges = {'sam': mergeSam, 'binary': mergeRecords, 'coverage': mergeCoverage}
+    merged_files = [merges[output](out_dir, sample, n_shards) for output in outputs]
+    return [merged_file for merged_file in merged_files if merged_file]
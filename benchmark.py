@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+import aligner
+
+'''
+benchmark of the stages of aligner.py on simulated reads
+
+simulateReads draws reads from a reference fasta with seeded substitution and indel errors, scalePanel grows a panel to any
+number of amplicons from mutated copies of its references. runCase times hashReferences, getReads and alignReads on one panel
+and depth, best of a few repeats, then runs each stage once more under tracemalloc for the peak memory it allocates.
+results are written as json, and compared against a baseline written by an earlier run: a stage slower or bigger than the
+baseline by more than the allowed fraction, or a drop in the fraction of reads placed on their true reference, fails the run.
+'''
+
+BASES = 'ACGT'
+#stage times and peaks below these are too small to compare reliably
+MIN_COMPARED_SECONDS = 0.25
+MIN_COMPARED_MB = 1.0
+
+def readReferences(fasta):
+    '''
+    @param fasta: path to a plain or gzipped fasta file
+    @return: list of (name, sequence) of the references in fasta, in file order
+    '''
+    refs = []
+    for ref_name, line in aligner.readFasta(fasta):
+        if not refs or refs[-1][0] != ref_name:
+            refs.append([ref_name, []])
+        refs[-1][1].append(line.decode('ascii'))
+    return [(name, ''.join(lines)) for name, lines in refs]
+
+def writeFasta(refs, path, line_length=80):
+    '''
+    @param refs: list of (name, sequence)
+    @param path: fasta file to write, sequences are wrapped at line_length
+    '''
+    with open(path, 'w') as f:
+        for name, seq in refs:
+            f.write(">%s\n" % name)
+            for i in range(0, len(seq), line_length):
+                f.write(seq[i:i + line_length] + "\n")
+
+def mutate(seq, rng, error_rate, indel_rate):
+    '''
+    @param seq: sequence to copy
+    @param rng: random.Random to draw errors with
+    @param error_rate: chance of each base being substituted
+    @param indel_rate: chance of an insertion or deletion (one each half the time) at each base
+    @return: copy of seq with the errors
+    '''
+    out = []
+    for base in seq:
+        draw = rng.random()
+        if draw < indel_rate / 2:
+            continue
+        if draw < indel_rate:
+            out.append(rng.choice(BASES))
+        if rng.random() < error_rate:
+            base = rng.choice(BASES.replace(base, '') if base in BASES else BASES)
+        out.append(base)
+    return ''.join(out)
+
+def scalePanel(ref_file, n_amplicons, out_file, divergence=0.1, seed=0):
+    '''
+    @param ref_file: fasta of the panel to grow
+    @param n_amplicons: number of amplicons in the grown panel
+    @param out_file: fasta file to write the grown panel to
+    @param divergence: substitution rate of the copies, so they do not share every k-mer with the references they were copied from
+    @param seed: seed of the copies, the same seed always gives the same panel
+    @return: out_file
+    '''
+    rng = random.Random(seed)
+    refs = readReferences(ref_file)
+    panel = list(refs[:n_amplicons])
+    while len(panel) < n_amplicons:
+        name, seq = refs[len(panel) % len(refs)]
+        panel.append(("%s_copy%d" % (name, len(panel) // len(refs)), mutate(seq, rng, divergence, 0)))
+    writeFasta(panel, out_file)
+    return out_file
+
+def simulateReads(ref_file, out_prefix, read_length=150, depth=100, error_rate=0.001, indel_rate=0.0002, paired=False, insert_size=250, seed=0):
+    '''
+    @param ref_file: fasta of the references to draw reads from
+    @param out_prefix: reads are written to <out_prefix>_R1.fastq (and <out_prefix>_R2.fastq when paired)
+    @param read_length: length of each read, or of the whole reference when it is shorter
+    @param depth: mean coverage of every reference
+    @param error_rate, indel_rate: chance of a substitution and of an indel at each base of a read, see mutate
+    @param paired: draw read pairs from fragments of insert_size bases, read2 is taken from the forward strand like read1 as aligner.py only places reads on it
+    @param seed: seed of the reads, the same seed always gives the same files
+    @return: list of the fastq files written, reads are named sim<n>:<reference>:<start> so their true placement is known
+    '''
+    rng = random.Random(seed)
+    read_files = ["%s_R1.fastq" % out_prefix] + (["%s_R2.fastq" % out_prefix] if paired else [])
+    outs = [open(read_file, 'w') for read_file in read_files]
+    n = 0
+    try:
+        for name, seq in readReferences(ref_file):
+            fragment_length = min(insert_size if paired else read_length, len(seq))
+            n_reads = max(1, int(round(depth * len(seq) / float(read_length * len(outs)))))
+            for i in range(n_reads):
+                start = rng.randint(0, len(seq) - fragment_length)
+                fragment = seq[start:start + fragment_length]
+                mates = [fragment[:read_length], fragment[-read_length:]][:len(outs)]
+                for out, mate in zip(outs, mates):
+                    mate = mutate(mate, rng, error_rate, indel_rate)
+                    out.write("@sim%d:%s:%d\n%s\n+\n%s\n" % (n, name, start, mate, 'I' * len(mate)))
+                n += 1
+    finally:
+        for out in outs:
+            out.close()
+    logging.info("simulated %d reads of %s at depth %s into %s" % (n, ref_file, depth, ", ".join(read_files)))
+    return read_files
+
+def measure(func, repeats):
+    '''
+    @param func: function taking no arguments to measure
+    @param repeats: number of timed calls
+    @return seconds: fastest wall time of the timed calls
+    @return peak_mb: peak memory allocated by one more call, traced by tracemalloc which would slow the timed calls
+    @return value: what the last call returned
+    '''
+    seconds = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        value = func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak / float(1 << 20), value
+
+def runCase(name, ref_file, read_files, repeats=3, hash_length=0, window=0, max_occurrences=0, band=0, batch_size=10000, processes=1):
+    '''
+    @param name: name of the case in the results
+    @param ref_file: fasta of the panel
+    @param read_files: fastq files of the reads as written by simulateReads
+    @param repeats: number of timed runs of each stage
+    @param hash_length, window, max_occurrences, band, batch_size, processes: alignment settings, see aligner.py
+    @return: dictionary of the seconds and peak_mb of each stage, counters of the alignment and fraction of reads placed on their true reference
+    '''
+    import numpy as np
+    read2_file = read_files[1] if len(read_files) > 1 else ''
+    paired = read2_file != ''
+    stages = dict()
+    read_length = aligner.peekReads(aligner.getReads(read_files[0], read2_file, batch_size), paired)[0]
+    seconds, peak_mb, hashed = measure(lambda: aligner.hashReferences(ref_file, read_length, hash_length, None, window, max_occurrences), repeats)
+    stages['hashReferences'] = {'seconds': seconds, 'peak_mb': peak_mb}
+    seconds, peak_mb, batches = measure(lambda: list(aligner.getReads(read_files[0], read2_file, batch_size)), repeats)
+    stages['getReads'] = {'seconds': seconds, 'peak_mb': peak_mb}
+    index, reference_locs, x_locs, combined_ref, coords = hashed
+    def align():
+        counters = Counter()
+        results = [result for batch, result in aligner.alignReads(index, combined_ref, index.hash_length, batches, paired, counters=counters,
+                                                                   cache_size=0, processes=processes, band=band)]
+        return counters, results
+    seconds, peak_mb, aligned = measure(align, repeats)
+    stages['alignReads'] = {'seconds': seconds, 'peak_mb': peak_mb}
+    counters, results = aligned
+    #the true reference of each read is in its name, compare it to the reference it was placed on
+    seqs = [seq for batch in batches for seq in aligner.batchSeqs(batch, paired)]
+    truth = [read.name.split(':')[1] for batch in batches for reads in batch for read in (reads if paired else [reads])]
+    loc = np.concatenate([result.loc for result in results]) if results else np.zeros(0, dtype=np.int64)
+    ref_id = aligner.resolveCoordinates(coords, loc, loc + np.array([len(seq) for seq in seqs], dtype=np.int64)).ref_id
+    placed = [coords.names[i] if i != -1 and l != -1 else None for i, l in zip(ref_id.tolist(), loc.tolist())]
+    correct = sum(1 for true_ref, placed_ref in zip(truth, placed) if true_ref == placed_ref)
+    n_reads = len(seqs)
+    return {'name': name, 'ref_file': ref_file, 'read_files': read_files, 'amplicons': len(coords.names), 'reads': n_reads,
+            'read_length': read_length, 'hash_length': index.hash_length, 'window': index.window, 'index_positions': len(index.positions),
+            'stages': stages, 'reads_per_second': n_reads / stages['alignReads']['seconds'] if stages['alignReads']['seconds'] else 0,
+            'correct_fraction': correct / float(n_reads) if n_reads else 0, 'counters': dict(counters)}
+
+def compareBaseline(results, baseline, max_regression=0.2, max_accuracy_drop=0.01):
+    '''
+    @param results: results of this run, as written by main
+    @param baseline: results of an earlier run to compare to
+    @param max_regression: largest allowed fractional increase of a stage's seconds or peak_mb over the baseline
+    @param max_accuracy_drop: largest allowed drop in the fraction of reads placed on their true reference
+    @return: list of descriptions of every regression, cases missing from either run are not compared
+    '''
+    regressions = []
+    base_cases = dict((case['name'], case) for case in baseline['cases'])
+    for case in results['cases']:
+        base = base_cases.get(case['name'])
+        if base is None:
+            continue
+        for stage, info in case['stages'].items():
+            base_info = base['stages'].get(stage)
+            if base_info is None:
+                continue
+            for key, floor in (('seconds', MIN_COMPARED_SECONDS), ('peak_mb', MIN_COMPARED_MB)):
+                if info[key] > max(base_info[key], floor) * (1 + max_regression):
+                    regressions.append("%s %s %s: %.3f, baseline %.3f (+%.0f%%)" % (
+                        case['name'], stage, key, info[key], base_info[key], 100.0 * (info[key] / base_info[key] - 1) if base_info[key] else float('inf')))
+        if case['correct_fraction'] < base['correct_fraction'] - max_accuracy_drop:
+            regressions.append("%s correct_fraction: %.4f, baseline %.4f" % (case['name'], case['correct_fraction'], base['correct_fraction']))
+    return regressions
+
+def parseList(text, type=int):
+    return [type(item) for item in text.split(",") if item]
+
+def main():
+    parser = argparse.ArgumentParser(description="time the stages of aligner.py on reads simulated from a reference")
+    required_group = parser.add_argument_group("required arguments")
+    required_group.add_argument("-f", "--reference-fasta", dest="ref", required=True, help="fasta of the panel to simulate reads from")
+    optional_group = parser.add_argument_group("optional arguments")
+    optional_group.add_argument("-o", "--out-dir", dest="odir", metavar="DIR", help="directory to write simulated panels, reads and results to [default: `pwd`]")
+    optional_group.add_argument("--amplicons", dest="amplicons", default="0", help="comma separated panel sizes to grow the reference to, 0 for the reference as it is [default: 0]")
+    optional_group.add_argument("--depths", dest="depths", default="100", help="comma separated mean coverages to simulate reads at [default: 100]")
+    optional_group.add_argument("--read-length", dest="read_length", type=int, default=150, help="length of simulated reads [default: 150]")
+    optional_group.add_argument("--error-rate", dest="error_rate", type=float, default=0.001, help="substitution rate of simulated reads [default: 0.001]")
+    optional_group.add_argument("--indel-rate", dest="indel_rate", type=float, default=0.0002, help="indel rate of simulated reads [default: 0.0002]")
+    optional_group.add_argument("--paired", dest="paired", action="store_true", help="simulate read pairs")
+    optional_group.add_argument("--insert-size", dest="insert_size", type=int, default=250, help="fragment length of simulated read pairs [default: 250]")
+    optional_group.add_argument("--seed", dest="seed", type=int, default=0, help="seed of simulated panels and reads [default: 0]")
+    optional_group.add_argument("--simulate-only", dest="simulate_only", action="store_true", help="only write the simulated panels and reads")
+    optional_group.add_argument("--repeats", dest="repeats", type=int, default=3, help="timed runs of each stage, the fastest is kept [default: 3]")
+    optional_group.add_argument("--results", dest="results", default="", help="file to write results to [default: OUT_DIR/benchmark.json]")
+    optional_group.add_argument("--baseline", dest="baseline", default="", help="results of an earlier run to compare to, regressions fail the run [default: '']")
+    optional_group.add_argument("--max-regression", dest="max_regression", type=float, default=0.2, help="fraction a stage may be slower or bigger than the baseline by [default: 0.2]")
+    alignment_group = parser.add_argument_group("alignment arguments")
+    alignment_group.add_argument("--hash-length", dest="hash_length", type=int, default=0, help="see aligner.py [default: 0]")
+    alignment_group.add_argument("--window", dest="window", type=int, default=0, help="see aligner.py [default: 0]")
+    alignment_group.add_argument("--max-occurrences", dest="max_occurrences", type=int, default=0, help="see aligner.py [default: 0]")
+    alignment_group.add_argument("--band", dest="band", type=int, default=0, help="see aligner.py [default: 0]")
+    alignment_group.add_argument("--batch-size", dest="batch_size", type=int, default=10000, help="see aligner.py [default: 10000]")
+    alignment_group.add_argument("-p", "--processes", dest="processes", type=int, default=1, help="see aligner.py [default: 1]")
+    args = parser.parse_args()
+    out_dir = args.odir or os.getcwd()
+    os.makedirs(out_dir, exist_ok=True)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
+    settings = dict((key, value) for key, value in vars(args).items() if key not in ('odir', 'results', 'baseline', 'simulate_only'))
+    cases = []
+    for n_amplicons in parseList(args.amplicons):
+        ref_file = args.ref
+        if n_amplicons > 0:
+            ref_file = scalePanel(args.ref, n_amplicons, os.path.join(out_dir, "panel%d.fasta" % n_amplicons), seed=args.seed)
+        for depth in parseList(args.depths, float):
+            name = "amplicons%d_depth%g" % (n_amplicons, depth)
+            read_files = simulateReads(ref_file, os.path.join(out_dir, name), args.read_length, depth, args.error_rate, args.indel_rate,
+                                       args.paired, args.insert_size, args.seed)
+            if args.simulate_only:
+                continue
+            case = runCase(name, ref_file, read_files, args.repeats, args.hash_length, args.window, args.max_occurrences, args.band,
+                           args.batch_size, args.processes)
+            cases.append(case)
+            print("%-28s %6d amplicons %9d reads  hash %6.3fs  reads %6.3fs  align %7.3fs  %9.0f reads/s  peak %7.1f MB  correct %.4f" % (
+                name, case['amplicons'], case['reads'], case['stages']['hashReferences']['seconds'], case['stages']['getReads']['seconds'],
+                case['stages']['alignReads']['seconds'], case['reads_per_second'], max(stage['peak_mb'] for stage in case['stages'].values()),
+                case['correct_fraction']))
+    if args.simulate_only:
+        return 0
+    results = {'settings': settings, 'created': time.time(), 'python': sys.version.split()[0], 'cases': cases}
+    results_file = args.results or os.path.join(out_dir, "benchmark.json")
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info("wrote results to %s" % results_file)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compareBaseline(results, baseline, args.max_regression)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            return 1
+        print("no regressions against %s" % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
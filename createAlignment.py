@@ -5,9 +5,12 @@ import argparse
 import logging
 
 import dispatcher
+import aligner
+import metrics
 '''
 dependencies
 -python3
+-numpy
 
 '''
 
@@ -34,12 +37,63 @@ def expandPath(path):
         path = os.path.expanduser(path)
     return os.path.abspath(path)
 
+def gzipSize(path):
+    '''
+    @param path: gzipped file
+    @return: uncompressed size modulo 2**32 from the gzip trailer of path, as gzip -l reports it, without decompressing anything
+    '''
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        #smaller than an empty gzip member, so there is no trailer to read
+        if f.tell() < 18:
+            return 0
+        f.seek(-4, 2)
+        return int.from_bytes(f.read(4), 'little')
+
+def readFileStats(path, sample_bytes=1 << 20):
+    '''
+    @param path: fastq file, may be gzipped
+    @param sample_bytes: bytes read from the start of path to measure its record size and compression ratio
+    @return: compressed size, uncompressed size and estimated number of reads of path
+    '''
+    import zlib
+    compressed_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(sample_bytes)
+    if head[:2] == b'\x1f\x8b':
+        #bgzip and other multi member files are a series of gzip members, each needs its own decompressor
+        text = b''
+        rest = head
+        while rest and len(text) < 4 * sample_bytes:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            text += decompressor.decompress(rest, 4 * sample_bytes - len(text))
+            if not decompressor.eof:
+                rest = decompressor.unconsumed_tail
+                break
+            rest = decompressor.unused_data
+        consumed = len(head) - len(rest)
+        ratio_size = compressed_size * len(text) / float(max(consumed, 1))
+        #the trailer is exact below 4 GB, so only the multiple of 2**32 it wrapped around is taken from the compression ratio
+        isize = gzipSize(path)
+        uncompressed_size = isize + (1 << 32) * max(0, int(round((ratio_size - isize) / float(1 << 32))))
+        #the trailer only covers the last member of multi member files such as bgzip output
+        if not 0.5 * ratio_size <= uncompressed_size <= 2 * ratio_size:
+            uncompressed_size = int(ratio_size)
+    else:
+        text = head
+        uncompressed_size = compressed_size
+    lines = text.split(b'\n')
+    records = (len(lines) - 1) // 4
+    if records == 0:
+        return compressed_size, uncompressed_size, 0 if uncompressed_size == 0 else 1
+    record_bytes = sum(len(line) + 1 for line in lines[:4 * records]) / float(records)
+    return compressed_size, uncompressed_size, int(round(uncompressed_size / record_bytes))
+
 def findReads(path):
     '''
     @param: string of path to directory where read files are located
     @return: a list of tuples named Read that contain the sample name followed by an array containing one element, a path to the merged read file, or 2 elements, paths to read1 and read2 files
     '''
-    import subprocess
     from collections import namedtuple
     read_list = []
     read_tuple = namedtuple('read_tuple', ['sample', 'reads'])
@@ -49,7 +103,8 @@ def findReads(path):
             sample_name = is_read.group(1)
             full_file = os.path.join(path, file)
             #check if read file is empty, if so add to read list with empty contents
-            if os.path.getsize(full_file) == 0 or (is_read.group(3) and subprocess.getoutput("gzip -l %s | awk 'NR > 1{print $2}'" % full_file) == '0'):
+            #gzip trailers of multi member files only give the size of the last member, so gzipped files are checked by decompressing their start
+            if readFileStats(full_file)[2] == 0:
                 logging.warning("Read file %s has no data, skipping..." % file)
                 read_list.append(read_tuple(sample_name, None))
                 continue
@@ -85,26 +140,95 @@ def findReads(path):
                     logging.info(read)
     return read_list
 
+def planSamples(read_list, max_reads_per_shard, plan_file):
+    '''
+    @param read_list: a list of read_tuples as returned by findReads
+    @param max_reads_per_shard: samples with more estimated reads (or read pairs) are split into read ranges of at most about this many reads, 0 to never split
+    @param plan_file: file to write the file sizes, estimated reads and number of shards of each sample to as json
+    @return: list of dispatcher.sample_shards to align, most estimated reads first so the longest tasks start first
+    '''
+    import json
+    import math
+    shards = []
+    plan = []
+    for read_tuple in read_list:
+        if read_tuple.reads is None:
+            continue
+        stats = [readFileStats(read_file) for read_file in read_tuple.reads]
+        #read2 has as many reads as read1, so pairs are counted from read1 alone
+        est_reads = stats[0][2]
+        n_shards = 1
+        if max_reads_per_shard > 0:
+            n_shards = max(1, int(math.ceil(est_reads / float(max_reads_per_shard))))
+        shard_reads = int(math.ceil(est_reads / float(n_shards)))
+        for shard in range(n_shards):
+            first_read = shard * shard_reads
+            #the last shard reads to the end of the file in case the estimate was low
+            last_read = -1 if shard == n_shards - 1 else first_read + shard_reads
+            shards.append(dispatcher.sample_shard(read_tuple.sample, read_tuple.reads, first_read, last_read, shard, n_shards,
+                                                  max(0, min(shard_reads, est_reads - first_read))))
+        plan.append({'sample': read_tuple.sample, 'reads': read_tuple.reads, 'compressed_bytes': sum(stat[0] for stat in stats),
+                     'uncompressed_bytes': sum(stat[1] for stat in stats), 'est_reads': est_reads, 'n_shards': n_shards})
+        logging.info("%s: %d compressed bytes, about %d reads, %d shards" % (read_tuple.sample, plan[-1]['compressed_bytes'], est_reads, n_shards))
+    with open(plan_file, 'w') as f:
+        json.dump(plan, f, indent=2)
+    return sorted(shards, key=lambda shard: -shard.est_reads)
+
+def peekReadLength(read_list, reads_per_sample=1000):
+    '''
+    @param read_list: a list of read_tuples as returned by findReads
+    @param reads_per_sample: number of reads to look at from the start of each read file
+    @return: longest read length seen, used as the padding between references in the shared index
+    '''
+    read_length = -1
+    for read_tuple in read_list:
+        if read_tuple[1] is None:
+            continue
+        for read_file in read_tuple[1]:
+            for i, read in zip(range(reads_per_sample), aligner.readFastq(read_file)):
+                read_length = max(read_length, len(read.seq))
+    return read_length
+
 def main():
     try:
         parser = argparse.ArgumentParser()
         required_group = parser.add_argument_group("required arguments")
         required_group.add_argument("-n", "--name", required=True, help="name for this run. [REQUIRED]")
-        required_group.add_argument("-f", "--fasta", metavar="REFERENCE FILE", required=True, type=argparse.FileType('r'), help="Fasta file of reference sequences. [REQUIRED]")
-        required_group.add_argument("-r", "--read-dir", dest="rdir", metavar="READ DIRECTORY", required=True,  help="Directory of reads to be aligned. [REQUIRED]")
+        required_group.add_argument("-f", "--fasta", metavar="REFERENCE FILE", type=argparse.FileType('r'), help="Fasta file of reference sequences. [REQUIRED unless --summarize]")
+        required_group.add_argument("-r", "--read-dir", dest="rdir", metavar="READ DIRECTORY", help="Directory of reads to be aligned. [REQUIRED unless --summarize]")
         optional_group = parser.add_argument_group("optional arguments")
         optional_group.add_argument("-o", "--out-dir", dest="odir", metavar="DIR", help="directory to write output files to. [default: `pwd`]")
+        optional_group.add_argument("--summarize", dest="summarize", action="store_true", help="only summarize the per sample metrics already in OUT_DIR into NAME_summary.json")
         optional_group.add_argument("-j", "--job_manager", dest="job_manager", default="SLURM", help="cluster job submitter to use (PBS, SLURM, SGE, none). [default: SLURM]")
+        optional_group.add_argument("--samples-per-task", dest="samples_per_task", type=int, default=1, help="number of samples aligned one after another by each task of the array job, so small samples share one process and index load [default: 1]")
+        optional_group.add_argument("--max-reads-per-shard", dest="max_reads_per_shard", type=int, default=4000000, help="split samples with more estimated reads into shards aligned by separate tasks, and pack smaller samples into tasks of up to this many reads, 0 to never split [default: 4000000]")
+        optional_group.add_argument("--resubmit-failed", dest="resubmit_failed", action="store_true", help="resubmit only the samples of run NAME whose array job tasks wrote no metrics to OUT_DIR")
         alignment_group = parser.add_argument_group("optional alignment arguments")
-        alignment_group.add_argument("--hash-length" , dest="hash_length", required=False, type=int, default=5, help="reference subsequence length [default: 5]")
+        alignment_group.add_argument("--hash-length" , dest="hash_length", required=False, type=int, default=0, help="reference subsequence length, 0 to pick it from the size of the references and the read length [default: 0]")
+        alignment_group.add_argument("--window", dest="window", required=False, type=int, default=0, help="only index and seed with the minimizer of every WINDOW consecutive subsequences, 0 to pick it from the hash length, 1 to use every subsequence [default: 0]")
+        alignment_group.add_argument("--max-occurrences", dest="max_occurrences", required=False, type=int, default=0, help="leave subsequences found at more places in the references out of the index, 0 to pick the threshold from their counts, -1 to keep all [default: 0]")
+        optional_group.add_argument("--local-cpus", dest="local_cpus", type=int, help="with -j none, cpus the alignment server aligns reads on, or with --no-server cpus shared by the samples aligned at once [default: all available]")
+        optional_group.add_argument("--local-mem", dest="local_mem", type=float, help="with -j none --no-server, GB of memory shared by the samples aligned at once [default: all available]")
+        optional_group.add_argument("--retries", dest="retries", type=int, default=1, help="with -j none --no-server, times a failed sample is rerun [default: 1]")
+        optional_group.add_argument("--no-server", dest="no_server", action="store_true", help="with -j none, run each sample in its own aligner.py process instead of one resident alignment server")
+        alignment_group.add_argument("--cache-dir", dest="cache_dir", required=False, help="directory to cache reference indexes in [default: OUT_DIR/index_cache]")
+        alignment_group.add_argument("--cache-max-age", dest="cache_max_age", required=False, type=int, default=30, help="days an unused cached index is kept for [default: 30]")
         #parse arguments
         args = parser.parse_args()
         program_name = args.name
+        if args.summarize:
+            out_dir = expandPath(args.odir) if args.odir else expandPath(os.getcwd())
+            metrics.summarizeMetrics(out_dir, program_name)
+            return 0
+        if not args.fasta or not args.rdir:
+            parser.error("-f/--fasta and -r/--read-dir are required unless --summarize is given")
         ref_filename = expandPath(args.fasta.name)
         read_dir = args.rdir
         out_dir = args.odir
         job_manager = args.job_manager
         hash_length = args.hash_length
+        cache_dir = args.cache_dir
+        cache_max_age = args.cache_max_age
         #make out_dir and read_dir current directory if not speicified
         if not out_dir:
             out_dir = expandPath(os.getcwd())
@@ -114,13 +238,15 @@ def main():
             read_dir = expandPath(os.getcwd())
         else:
             read_dir = expandPath(read_dir)
-        #if the output path already exists check if should overwrite
-        if os.path.exists(out_dir):
+        if args.resubmit_failed and job_manager == "none":
+            parser.error("--resubmit-failed only applies to array jobs submitted to PBS, SLURM or SGE")
+        #if the output path already exists check if should overwrite, a resubmission writes to the output folder of the run it resubmits
+        if os.path.exists(out_dir) and not args.resubmit_failed:
             response = input("\nOutput folder %s already exists!\nFiles in it may be overwritten!\nShould we continue anyway [N]? " % out_dir)
             if not re.match('^[Yy]', response):
                 print("Operation cancelled!")
                 quit()
-        else:
+        elif not os.path.exists(out_dir):
             os.makedirs(out_dir)
         #set up logging in output directory
         logfile = os.path.join(out_dir, "TEMP.log")
@@ -131,16 +257,85 @@ def main():
                             filemode='w')
         logging.info("Aligning reads in %s to refs in fasta file: %s for run: %s" % (read_dir, ref_filename, program_name))
         #get reads into a list of read_tuples
-        read_list = findReads(read_dir)
-
-        #align the reads to references
-        for read_tuple in read_list:
-            dispatcher.startAlignment(read_tuple, ref_filename, out_dir, job_manager, hash_length)
+        if args.resubmit_failed:
+            shards = dispatcher.failedSamples(out_dir, program_name)
+            logging.info("Resubmitting %d samples that did not finish" % len(shards))
+            if not shards:
+                return 0
+        else:
+            read_list = findReads(read_dir)
+            #size every sample up front, so big samples are split and every job asks for resources matching its work
+            max_reads_per_shard = args.max_reads_per_shard if job_manager != "none" else 0
+            shards = planSamples(read_list, max_reads_per_shard, os.path.join(out_dir, "%s_plan.json" % program_name))
+        #build the reference index once, every job loads it instead of rebuilding it
+        import kmerindex
+        if not cache_dir:
+            cache_dir = os.path.join(out_dir, "index_cache")
+        else:
+            cache_dir = expandPath(cache_dir)
+        kmerindex.evictIndexes(cache_dir, cache_max_age)
+        read_length = peekReadLength(shards)
+        index_file = kmerindex.cachedIndex(cache_dir, ref_filename, hash_length, read_length,
+                                           lambda: aligner.hashReferences(ref_filename, read_length, hash_length, None, args.window, args.max_occurrences)[0],
+                                           args.window, args.max_occurrences)
+        logging.info("Using reference index %s" % index_file)
+        #without a cluster, one resident server loads the index once and aligns every sample
+        server = ''
+        server_proc = None
+        if job_manager == "none" and not args.no_server:
+            import tempfile
+            import alignclient
+            import localscheduler
+            #unix socket paths are limited to ~100 characters, so keep the socket out of out_dir
+            server = os.path.join(tempfile.gettempdir(), "amplicon_aligner_%d.sock" % os.getpid())
+            #the server aligns one sample at a time, so it spreads each sample over every cpu instead
+            server_cpus = args.local_cpus or localscheduler.availableCpus()
+            server_proc = alignclient.startServer(server, ['-f', ref_filename, '--index', index_file, '--hash-length', str(hash_length), '--read-length', str(read_length), '-o', out_dir,
+                                                   '-p', str(server_cpus)],
+                                                  log_file=os.path.join(out_dir, "server.out"))
+        elif job_manager == "none":
+            dispatcher.localScheduler(args.local_cpus, args.local_mem, args.retries)
+        try:
+            #align the reads to references
+            if job_manager == "none":
+                jobids = [dispatcher.startAlignment(shard, ref_filename, out_dir, job_manager, hash_length, index_file, server, shard.est_reads)
+                          for shard in shards]
+            else:
+                #one array job for the whole run instead of a job per sample
+                dispatcher.startArrayAlignment(shards, ref_filename, out_dir, job_manager, hash_length, program_name, index_file,
+                                               args.samples_per_task, args.max_reads_per_shard)
+            if job_manager == "none":
+                #everything runs on this machine, so wait for it and summarize the run
+                if server:
+                    failed = [jobid for jobid in jobids if alignclient.waitJob(server, jobid)['state'] != 'done']
+                else:
+                    states = dispatcher.localScheduler().wait(jobids)
+                    failed = [jobid for jobid in jobids if states[jobid] != 'done']
+        finally:
+            #every sample is finished by now unless something went wrong, and then the server must not outlive the run
+            if server_proc is not None:
+                alignclient.stopServer(server, server_proc)
+            elif job_manager == "none":
+                import json
+                #likewise local jobs are killed rather than orphaned, and recorded as failed or cancelled in the report
+                scheduler = dispatcher.localScheduler()
+                scheduler.cancel()
+                scheduler.wait(timeout=60)
+                with open(os.path.join(out_dir, "%s_local_jobs.json" % program_name), 'w') as f:
+                    json.dump(scheduler.report(), f, indent=2)
+        if job_manager == "none":
+            metrics.summarizeMetrics(out_dir, program_name)
+            if failed:
+                logging.error("%d of %d samples failed, see their logs in %s" % (len(failed), len(jobids), out_dir))
+                sys.stderr.write("%s: %d of %d samples failed, see their logs in %s\n" % (program_name, len(failed), len(jobids), out_dir))
+                return 1
         #aligner.align(read_list, references)
 
         return 0
     except KeyboardInterrupt:
-        return 0
+        #128 + SIGINT, as a shell reports a run killed by ctrl-c
+        sys.stderr.write("%s: interrupted\n" % program_name)
+        return 130
     except Exception as e:
         if DEBUG or TESTRUN:
             raise(e)
@@ -151,4 +346,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,7 +1,29 @@
 import logging
-import aligner
+from collections import namedtuple
 
-def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False, notify=False):
+#a sample, or one read range of a sample too big to align in one task
+sample_shard = namedtuple('sample_shard', ['sample', 'reads', 'first_read', 'last_read', 'shard', 'n_shards', 'est_reads'])
+
+#conservative number of reads one aligner process gets through in an hour, used to size walltime requests
+READS_PER_CPU_HOUR = 5000000
+#a job gets another cpu for every this many reads it aligns, up to MAX_CPUS
+READS_PER_CPU = 1000000
+MAX_CPUS = 8
+
+_local_scheduler = None
+
+def localScheduler(max_cpus=None, max_mem_gb=None, retries=1):
+    '''
+    @param max_cpus, max_mem_gb, retries: limits of the scheduler, see localscheduler.LocalScheduler, only used by the first call
+    @return: the scheduler running job_manager none jobs on this machine
+    '''
+    global _local_scheduler
+    if _local_scheduler is None:
+        import localscheduler
+        _local_scheduler = localscheduler.LocalScheduler(max_cpus, max_mem_gb, retries)
+    return _local_scheduler
+
+def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False, notify=False, array=''):
     import subprocess
     import re
     import os
@@ -21,13 +43,16 @@ def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False,
             args += " -h"
         if notify:
             args += " -m e"
+        if array:
+            args += " -J %s" % array
         submit_command = "qsub -V -d \'%s\' -w \'%s\' -l ncpus=%s,mem=%sgb,walltime=%s:00:00 -m a -N \'%s\' %s %s %s" % (
             job_parms["work_dir"], job_parms["work_dir"], job_parms['num_cpus'], job_parms['mem_requested'],
             job_parms['walltime'], job_parms['name'], waitfor, queue, args)
         logging.debug("submit_command = %s", submit_command)
         output = subprocess.getoutput("echo \"%s\" | %s - " % (command, submit_command))
         logging.debug("output = %s" % output)
-        job_match = re.search('^(\d+)\..*$', output)
+        #array jobs are reported as 1234[].server
+        job_match = re.search('^(\d+)(?:\[\])?\..*$', output)
         if job_match:
             jobid = job_match.group(1)
         else:
@@ -45,6 +70,8 @@ def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False,
             args += " -H"
         if notify:
             args += " --mail-type=END"
+        if array:
+            args += " --array=%s" % array
         #submit_command = "sbatch -D \'%s\' -c%s --mem=%s000 --time=%s:00:00 --mail-type=FAIL -J \'%s\' %s %s %s" % (
         #    job_parms["work_dir"], job_parms['num_cpus'], job_parms['mem_requested'], job_parms['walltime'],
         #    job_parms['name'], waitfor, queue, args)
@@ -71,6 +98,8 @@ def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False,
             args += " -h"
         if notify:
             args += " -m e"
+        if array:
+            args += " -t %s" % array
         mem_needed = float(job_parms['mem_requested']) * 1024 * 1024
         # Apparently the number of processors a job uses is controlled by the queue it is running on in SGE, so there is no way to request a specific number of CPUs??
         submit_command = "qsub -V -cwd \'%s\' -wd \'%s\' -l h_data=%sgb,h_rt=%s:00:00 -m a -N \'%s\' %s %s %s" % (
@@ -79,48 +108,48 @@ def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False,
         logging.debug("submit_command = %s", submit_command)
         output = subprocess.getoutput("echo \"%s\" | %s - " % (command, submit_command))
         logging.debug("output = %s" % output)
-        job_match = re.search('^(\d+)\..*$', output)
+        #array jobs are reported as Your job-array 1234.1-10:1
+        job_match = re.search('^(\d+)\..*$', output) or re.search('^Your job-array (\d+)\.', output)
         if job_match:
             jobid = job_match.group(1)
         else:
             logging.warning("Job not submitted!!")
             print("WARNING: Job not submitted: %s" % output)
     else:
-        command = re.sub('\n', '; ', command)
-        work_dir = job_parms['work_dir']
-        dependency_check = ""
-        if waitfor_id:
-            if re.search(":", waitfor_id[0]):
-                pid_filename = os.path.join(work_dir, "%s_dependent_pids" % job_parms['name'])
-                pid_file = open(pid_filename, 'w')
-                pids = waitfor_id[0].split(":")
-                pid_file.write("\n".join(pids))
-                pid_file.close()
-                dependency_check = "while [ -s %s ]; do sleep 600; for pid in `cat %s`; do kill -0 \"$pid\" 2>/dev/null || sed -i \"/^$pid$/d\" %s; done; done; rm %s; " % (
-                    pid_filename, pid_filename, pid_filename, pid_filename)
-            else:
-                pid = waitfor_id[0]
-                dependency_check = "while kill -0 %s; do sleep 300; done; " % pid
-        # cpu_check = "grep 'cpu ' /proc/stat | awk '{usage=($2+$4)/($2+$4+$5)} END {print 1-usage}'"
-        total_mem = subprocess.getoutput("free -g | grep Mem: | awk '{ print $2 }'")
-        mem_requested = job_parms['mem_requested']
-        if mem_requested > total_mem:
-            mem_requested = total_mem
-        print("total_mem = %s" % total_mem)
-        mem_needed = float(mem_requested) * 750
-        mem_check = "while [ `free -m | grep cache: | awk '{ print $4 }'` -lt %d ]; do sleep 300; done; " % mem_needed
-        submit_command = "%s%s%s" % (dependency_check, mem_check, command)
-        logging.debug("submit_command = %s" % submit_command)
-        output_log = os.open(os.path.join(work_dir, "%s.out" % job_parms['name']), os.O_WRONLY | os.O_CREAT)
-        proc = subprocess.Popen(submit_command, stderr=subprocess.STDOUT, stdout=output_log, shell=True, cwd=work_dir)
-        jobid = str(proc.pid)
+        #run on this machine, the local scheduler starts the job once the jobs it waits for are done and its cpus and memory are free
+        import shlex
+        waitfor = []
+        if waitfor_id and waitfor_id[0]:
+            waitfor = waitfor_id[0].split(":")
+        log_file = os.path.join(job_parms['work_dir'], "%s.out" % job_parms['name'])
+        jobid = localScheduler().submit(job_parms['name'], shlex.split(command), job_parms['num_cpus'], job_parms['mem_requested'],
+                                        waitfor, job_parms['work_dir'], log_file)
     logging.info("jobid = %s" % jobid)
     return jobid
 
 
-def startAlignment(read_tuple, ref_filename, out_dir, job_manager, hash_length):
+def jobResources(est_reads, index_file=''):
+    '''
+    @param est_reads: estimated number of reads (or read pairs) the job aligns
+    @param index_file: k-mer index the job loads, its size is added to the memory requested
+    @return: job parameters with cpus, memory (GB) and walltime (hours) scaled to the work
+    '''
+    import math
+    import os
+    num_cpus = min(MAX_CPUS, max(1, int(math.ceil(est_reads / float(READS_PER_CPU)))))
+    index_gb = os.path.getsize(index_file) / float(1 << 30) if index_file and os.path.exists(index_file) else 0
+    #the index is memory mapped once and shared, each process adds a batch of reads and its alignment cache
+    mem_requested = int(math.ceil(1 + index_gb + 0.5 * num_cpus))
+    #ask for twice the expected time so slow nodes do not hit the limit
+    walltime = max(1, int(math.ceil(2.0 * est_reads / (READS_PER_CPU_HOUR * num_cpus))))
+    return {'queue':'', 'mem_requested':mem_requested, 'num_cpus':num_cpus, 'walltime':walltime, 'args':''}
+
+def startAlignment(read_tuple, ref_filename, out_dir, job_manager, hash_length, index_file='', server='', est_reads=None):
     #create a job for each read1-read2 file pair that puts these reads into memory
-    job_params = {'queue':'', 'mem_requested':8, 'num_cpus':2, 'walltime':24, 'args':''}
+    if est_reads is None:
+        job_params = {'queue':'', 'mem_requested':2, 'num_cpus':2, 'walltime':24, 'args':''}
+    else:
+        job_params = jobResources(est_reads, index_file)
     #read_tuple[0] is sample name
     job_params['name'] = "retrieveReads_%s" % read_tuple[0]
     job_params['work_dir'] = out_dir
@@ -129,7 +158,138 @@ def startAlignment(read_tuple, ref_filename, out_dir, job_manager, hash_length):
         read2 = read_tuple[1][1]
     else:
         read2 = ''
-    command = "python /scratch/zkoch/amplicon_aligner/aligner.py -s %s -r1 %s -r2 %s -f %s -o %s -j %s --hash-length %d" % (read_tuple[0], read1, read2, ref_filename, out_dir, job_manager, hash_length)
+    #a resident alignment server already has the reference loaded, hand it the sample instead of starting a process
+    if job_manager == "none" and server:
+        import alignclient
+        jobid = alignclient.submitSample(server, read_tuple[0], read1, read2, out_dir)
+        logging.info("submitted %s to alignment server %s as job %s" % (read_tuple[0], server, jobid))
+        return jobid
+    command = "python /scratch/zkoch/amplicon_aligner/aligner.py -s %s -r1 %s -f %s -o %s -j %s --hash-length %d --processes %d" % (read_tuple[0], read1, ref_filename, out_dir, job_manager, hash_length, job_params['num_cpus'])
+    #an empty -r2 would swallow the next option as its value
+    if read2:
+        command += " -r2 %s" % read2
+    #use the index built up front instead of having every job rebuild it
+    if index_file:
+        command += " --index %s" % index_file
     jobid = _submit_job(job_manager, command, job_params)
 
     return jobid
+
+def writeManifest(shards, manifest_file, samples_per_task=1, reads_per_task=0):
+    '''
+    @param shards: list of sample_shards to align, as planned by createAlignment.planSamples
+    @param manifest_file: file to write the tab separated manifest to, one line of task, sample, read1, read2 (or ''),
+                          first_read, last_read, shard, n_shards and est_reads per shard
+    @param samples_per_task: most shards packed into each array task, a task aligns its shards one after another against one loaded index
+    @param reads_per_task: estimated reads a task is filled up to before starting the next, 0 to pack by samples_per_task alone
+    @return: dictionary of task number (starting at 1) to the list of sample_shards it aligns
+    '''
+    tasks = dict()
+    task = 0
+    with open(manifest_file, 'w') as manifest:
+        for shard in shards:
+            packed = tasks.get(task, [])
+            if not packed or len(packed) >= samples_per_task or (reads_per_task and sum(s.est_reads for s in packed) + shard.est_reads > reads_per_task):
+                task += 1
+            read2 = shard.reads[1] if len(shard.reads) > 1 else ''
+            manifest.write("%d\t%s\t%s\t%s\t%d\t%d\t%d\t%d\t%d\n" % (task, shard.sample, shard.reads[0], read2, shard.first_read, shard.last_read,
+                                                                     shard.shard, shard.n_shards, shard.est_reads))
+            tasks.setdefault(task, []).append(shard)
+    return tasks
+
+def readSubmissions(out_dir, run_name):
+    '''
+    @return: list of the array job submissions recorded in out_dir/<run_name>_jobs.json, oldest first
+    '''
+    import json
+    import os
+    jobs_file = os.path.join(out_dir, "%s_jobs.json" % run_name)
+    if not os.path.exists(jobs_file):
+        return []
+    with open(jobs_file) as f:
+        return json.load(f)
+
+def startArrayAlignment(shards, ref_filename, out_dir, job_manager, hash_length, run_name, index_file='', samples_per_task=1, reads_per_task=0):
+    '''
+    @param shards: list of sample_shards to align, as planned by createAlignment.planSamples
+    @param run_name: name of the run, the manifest and job record are written to out_dir as <run_name>_manifest.tsv and <run_name>_jobs.json
+    @param samples_per_task, reads_per_task: how shards are packed into tasks, see writeManifest
+    @return: job id of the array job, None if nothing was submitted
+    '''
+    import json
+    import os
+    import time
+    import metrics
+    submissions = readSubmissions(out_dir, run_name)
+    #resubmissions get their own manifest so the tasks of earlier array jobs still map to the right samples
+    if submissions:
+        manifest_file = os.path.join(out_dir, "%s_manifest_%d.tsv" % (run_name, len(submissions)))
+    else:
+        manifest_file = os.path.join(out_dir, "%s_manifest.tsv" % run_name)
+    tasks = writeManifest(shards, manifest_file, samples_per_task, reads_per_task)
+    if not tasks:
+        logging.warning("No samples with reads to align, nothing submitted")
+        return None
+    #every task of an array job gets the same request, so size it for the task with the most work
+    task_reads = dict((task, sum(shard.est_reads for shard in packed)) for task, packed in tasks.items())
+    job_params = jobResources(max(task_reads.values()), index_file)
+    job_params['name'] = "align_%s" % run_name
+    job_params['work_dir'] = out_dir
+    #each task looks up its samples in the manifest by the array task id the job manager gives it
+    command = "python /scratch/zkoch/amplicon_aligner/aligner.py --manifest %s -f %s -o %s -j %s --hash-length %d --processes %d" % (manifest_file, ref_filename, out_dir, job_manager, hash_length, job_params['num_cpus'])
+    if index_file:
+        command += " --index %s" % index_file
+    submitted = time.time()
+    jobid = _submit_job(job_manager, command, job_params, array="1-%d" % len(tasks))
+    if jobid is None:
+        return None
+    logging.info("submitted %d shards in %d tasks of array job %s, requesting %d cpus, %d GB and %d hours per task" % (
+        len(shards), len(tasks), jobid, job_params['num_cpus'], job_params['mem_requested'], job_params['walltime']))
+    submissions.append({'jobid': jobid, 'job_manager': job_manager, 'manifest': manifest_file, 'submitted': submitted,
+                        'resources': dict((key, job_params[key]) for key in ['num_cpus', 'mem_requested', 'walltime']),
+                        'tasks': dict((str(task), [metrics.shardName(shard.sample, shard.shard, shard.n_shards) for shard in packed]) for task, packed in tasks.items()),
+                        'task_est_reads': dict((str(task), reads) for task, reads in task_reads.items())})
+    with open(os.path.join(out_dir, "%s_jobs.json" % run_name), 'w') as f:
+        json.dump(submissions, f, indent=2)
+    return jobid
+
+def failedSamples(out_dir, run_name):
+    '''
+    @param out_dir: directory the array jobs of the run wrote their output to
+    @param run_name: name of the run whose submissions are recorded in out_dir/<run_name>_jobs.json
+    @return: list of the sample_shards whose latest submission wrote no metrics file, run only once those jobs have finished
+    '''
+    import os
+    import alignoutput
+    import metrics
+    def finished(name, submission):
+        metrics_file = os.path.join(out_dir, "%s_metrics.json" % name)
+        #a metrics file from before the submission is left over from an earlier run
+        return os.path.exists(metrics_file) and os.path.getmtime(metrics_file) >= submission['submitted']
+    latest = dict()
+    for submission in readSubmissions(out_dir, run_name):
+        with open(submission['manifest']) as manifest:
+            for line in manifest:
+                fields = line.rstrip('\n').split('\t')
+                read1, read2 = fields[2], fields[3]
+                #manifests written before samples were sharded only have the first four columns, as in aligner.readManifest
+                shard_fields = [int(field) for field in fields[4:9]]
+                shard_fields += [0, -1, 0, 1, 0][len(shard_fields):]
+                shard = sample_shard(fields[1], [read1, read2] if read2 else [read1], *shard_fields)
+                latest[(shard.sample, shard.shard)] = (submission, fields[0], shard)
+    failed = []
+    for key, (submission, task, shard) in sorted(latest.items()):
+        name = metrics.shardName(shard.sample, shard.shard, shard.n_shards)
+        if finished(name, submission) or (shard.n_shards > 1 and finished(shard.sample, submission)):
+            continue
+        logging.info("%s in task %s of array job %s did not finish" % (name, task, submission['jobid']))
+        failed.append(shard)
+    #a sample whose shards all finished but were never merged is merged here instead of realigned
+    failed_samples = set(shard.sample for shard in failed)
+    unmerged = set((shard.sample, shard.n_shards) for submission, task, shard in latest.values()
+                   if shard.n_shards > 1 and not finished(shard.sample, submission))
+    for sample, n_shards in unmerged:
+        if sample not in failed_samples:
+            metrics.mergeShards(out_dir, sample, n_shards)
+            alignoutput.mergeOutputs(out_dir, sample, n_shards)
+    return failed
@@ -0,0 +1,201 @@
+from collections import namedtuple
+
+import numpy as np
+
+'''
+bit-parallel banded edit distance of reads against windows of combined_ref
+
+uses Myers' bit-vector algorithm in the formulation of Hyyro, with the read as the pattern and the stretch of combined_ref
+within band bases of a seed diagonal as the text, so the whole read is aligned while the window is free at both ends.
+bit i of a column is the difference between rows i + 1 and i of the dynamic programming matrix. bandedDistances scores
+many candidates at once with each column held as uint64 words, carries passed between the words, alignOps scores one
+read with python ints and keeps the columns to trace back its alignment.
+anything that is not ACGT (the x padding, N's) matches nothing, so bases hanging off a reference cost one each.
+'''
+
+edit_alignment = namedtuple('edit_alignment', ['loc', 'diff', 'aligned', 'cigar'])
+
+#maps ascii bytes to 2-bit codes, 4 marks a base that matches nothing
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    _BASE_CODES[_base] = _code
+
+def patternMasks(read_bytes):
+    '''
+    @param read_bytes: encoded reads as made by aligner.encodeReads
+    @return: uint64 array of shape (reads, 5, words), bit i of [r, c] is set when base i of read r has 2-bit code c, code 4 is always empty
+    '''
+    n_words = -(-read_bytes.shape[1] // 64)
+    codes = _BASE_CODES[read_bytes]
+    bits = np.zeros((len(read_bytes), 5, n_words * 64), dtype=bool)
+    for code in range(4):
+        bits[:, code, :read_bytes.shape[1]] = codes == code
+    return np.packbits(bits, axis=2, bitorder='little').view('<u8').astype(np.uint64)
+
+def _add(a, b):
+    '''
+    @return: a + b of multi word columns, carrying from each word into the next
+    '''
+    total = a + b
+    carry = total[:, 0] < a[:, 0]
+    for w in range(1, a.shape[1]):
+        word = total[:, w] + carry.astype(np.uint64)
+        carry = (total[:, w] < a[:, w]) | (word < carry)
+        total[:, w] = word
+    return total
+
+def _shiftLeft(a):
+    '''
+    @return: a << 1 of multi word columns, shifting the top bit of each word into the next
+    '''
+    shifted = a << np.uint64(1)
+    shifted[:, 1:] |= a[:, :-1] >> np.uint64(63)
+    return shifted
+
+def bandedDistances(ref_bytes, read_bytes, read_lengths, cand_reads, cand_starts, band, max_cells=1 << 22):
+    '''
+    @param ref_bytes: uint8 array of combined_ref
+    @param read_bytes, read_lengths: encoded reads as made by aligner.encodeReads
+    @param cand_reads, cand_starts: candidate windows as made by aligner.seedCandidates
+    @param band: the read may start and end up to this many bases either side of its diagonal
+    @param max_cells: maximum number of words updated in one numpy pass, bounds memory use
+    @return dists: edit distance of each candidate's read to the stretch of combined_ref it matches best within the band
+    @return ends: position in combined_ref just past that stretch, the one closest to the end of the diagonal when tied
+    '''
+    width = read_bytes.shape[1]
+    peq = patternMasks(read_bytes)
+    n_words = peq.shape[2]
+    #pad with x's so windows hanging past either end of combined_ref cost the same as any other overhang
+    padding = width + band
+    text_codes = _BASE_CODES[np.concatenate((np.full(padding, ord('x'), dtype=np.uint8), ref_bytes, np.full(padding, ord('x'), dtype=np.uint8)))]
+    dists = np.zeros(len(cand_reads), dtype=np.int64)
+    ends = np.zeros(len(cand_reads), dtype=np.int64)
+    chunk = max(1, max_cells // ((width + 2 * band) * n_words))
+    for i in range(0, len(cand_reads), chunk):
+        reads = cand_reads[i:i + chunk]
+        rows = np.arange(len(reads))
+        m = read_lengths[reads]
+        #text of a candidate runs from band bases before its diagonal to band bases past the end of the read
+        first = cand_starts[i:i + chunk] - band + padding
+        n_text = m + 2 * band
+        high_word = (m - 1) // 64
+        high_bit = np.uint64(1) << ((m - 1) % 64).astype(np.uint64)
+        pv = np.full((len(reads), n_words), np.iinfo(np.uint64).max, dtype=np.uint64)
+        mv = np.zeros((len(reads), n_words), dtype=np.uint64)
+        score = m.copy()
+        best = m.copy()
+        best_j = np.zeros(len(reads), dtype=np.int64)
+        for j in range(int(n_text.max()) if len(reads) else 0):
+            eq = peq[reads, text_codes[first + j]]
+            xv = eq | mv
+            xh = (_add(eq & pv, pv) ^ pv) | eq
+            ph = mv | ~(xh | pv)
+            mh = pv & xh
+            score += (ph[rows, high_word] & high_bit) != 0
+            score -= (mh[rows, high_word] & high_bit) != 0
+            ph = _shiftLeft(ph)
+            mh = _shiftLeft(mh)
+            pv = mh | ~(xv | ph)
+            mv = ph & xv
+            #the end of the diagonal is column band + m, prefer ends closer to it on ties
+            closer = np.abs(j + 1 - band - m) < np.abs(best_j - band - m)
+            better = (j < n_text) & ((score < best) | ((score == best) & closer))
+            best[better] = score[better]
+            best_j[better] = j + 1
+        dists[i:i + chunk] = best
+        ends[i:i + chunk] = cand_starts[i:i + chunk] - band + best_j
+    return dists, ends
+
+def _popcount(x):
+    return bin(x).count('1')
+
+def alignOps(ref_bytes, seq, start, band):
+    '''
+    @param ref_bytes: uint8 array of combined_ref
+    @param seq: read sequence string
+    @param start: position in combined_ref of the diagonal to align seq around, may be negative or in x padding
+    @param band: the read may start and end up to this many bases either side of start
+    @return: edit_alignment of the best alignment of seq in the band, loc is where the first base of seq sits (clipped bases included),
+             diff counts mismatched, inserted and deleted bases, aligned counts read bases that are not clipped and cigar uses
+             M, I, D and S for bases hanging off the reference
+    '''
+    m = len(seq)
+    lo = start - band
+    #positions outside combined_ref are x's like the padding between references
+    text = np.full(m + 2 * band, 4, dtype=np.uint8)
+    window = slice(max(lo, 0), max(min(start + m + band, len(ref_bytes)), 0))
+    text[window.start - lo:window.stop - lo] = _BASE_CODES[ref_bytes[window]]
+    text = text.tolist()
+    read = _BASE_CODES[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)].tolist()
+    masks = [0] * 5
+    for i, code in enumerate(read):
+        masks[code] |= 1 << i
+    masks[4] = 0
+    full = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv = full, 0
+    columns = [(pv, mv)]
+    score = best = m
+    best_j = 0
+    for j, code in enumerate(text):
+        eq = masks[code]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = (ph << 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+        columns.append((pv, mv))
+        if score < best or (score == best and abs(j + 1 - band - m) < abs(best_j - band - m)):
+            best, best_j = score, j + 1
+    def cell(i, j):
+        #row 0 is all 0's as the read may start anywhere in the window, so a row is the sum of the differences above it
+        col_pv, col_mv = columns[j]
+        below = (1 << i) - 1
+        return _popcount(col_pv & below) - _popcount(col_mv & below)
+    #trace back from the best end, preferring diagonal steps so overhangs come out as clipped bases rather than insertions
+    ops = []
+    i, j, d = m, best_j, best
+    while i > 0:
+        if j > 0:
+            mismatch = int(text[j - 1] == 4 or text[j - 1] != read[i - 1])
+            if cell(i - 1, j - 1) + mismatch == d:
+                ops.append('S' if text[j - 1] == 4 else ('X' if mismatch else '='))
+                i, j, d = i - 1, j - 1, d - mismatch
+                continue
+        if cell(i - 1, j) + 1 == d:
+            ops.append('I')
+            i, d = i - 1, d - 1
+        else:
+            ops.append('D')
+            j, d = j - 1, d - 1
+    ops.reverse()
+    #insertions before the first or after the last aligned base are read bases the window did not reach, so they are clipped too
+    lead = next((k for k, op in enumerate(ops) if op not in 'SI'), len(ops))
+    trail = min(next((k for k, op in enumerate(reversed(ops)) if op not in 'SI'), len(ops)), len(ops) - lead)
+    loc = lo + j - sum(1 for op in ops[:lead] if op == 'I')
+    #bases against an N inside a reference are mismatches, only the ends of a read are clipped
+    ops = ['S'] * lead + ['X' if op == 'S' else op for op in ops[lead:len(ops) - trail]] + ['S'] * trail
+    diff = sum(1 for op in ops if op in 'XID')
+    aligned = sum(1 for op in ops if op in '=XI')
+    return edit_alignment(loc, diff, aligned, cigarString(ops))
+
+def cigarString(ops):
+    '''
+    @param ops: list of single character operations, = and X are written as M
+    @return: run length encoded cigar string of ops
+    '''
+    cigar = []
+    for op in ops:
+        op = 'M' if op in '=X' else op
+        if cigar and cigar[-1][1] == op:
+            cigar[-1][0] += 1
+        else:
+            cigar.append([1, op])
+    return ''.join("%d%s" % (length, op) for length, op in cigar)
@@ -0,0 +1,320 @@
+import json
+import logging
+import os
+from collections import namedtuple
+
+import numpy as np
+
+'''
+compact k-mer index of a combined reference
+
+k-mers are 2-bit encoded (A=0, C=1, G=2, T=3) into uint64 codes, so hash_length can be at most 32.
+positions are stored CSR style: kmers holds the sorted distinct codes, and the positions of kmers[j]
+in combined_ref are positions[offsets[j]:offsets[j + 1]], sorted from smaller to larger.
+k-mers containing anything other than ACGT (the x padding, N's) are never indexed.
+with a window above 1 only (window, hash_length)-minimizers are indexed: of every window consecutive k-mers, the one
+with the smallest hash. reads are seeded with their own minimizers, and any stretch of window + hash_length - 1 bases
+a read shares with the reference has the same minimizer in both. k-mers occurring more than max_occurrences times
+are masked, left out of the index, as their hits fan out without telling placements apart.
+
+index file layout (all integers little endian):
+    magic (8 bytes) | version (uint32) | header length (uint32) | json header | padding to 8 bytes | arrays
+the json header records hash_length, read_length, window, max_occurrences, masked, reference_locs, x_locs and the
+offset, dtype and length of each array, so every array can be memory-mapped read-only straight from the file.
+'''
+
+INDEX_MAGIC = b'AAKMERIX'
+#version 3 keeps only the first word of each fasta header as the reference name
+INDEX_VERSION = 3
+MAX_HASH_LENGTH = 32
+#auto picked k-mer lengths are never shorter than the old fixed default
+MIN_AUTO_HASH_LENGTH = 5
+#with an auto masking threshold, k-mers this frequent or less are always kept
+MIN_AUTO_MAX_OCCURRENCES = 32
+
+kmer_index = namedtuple('kmer_index', ['hash_length', 'read_length', 'kmers', 'offsets', 'positions', 'combined_ref', 'reference_locs', 'x_locs',
+                                       'window', 'max_occurrences', 'masked'])
+
+#maps ascii bytes to 2-bit codes, 4 marks a base that can not be encoded
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    _BASE_CODES[_base] = _code
+    _BASE_CODES[ord(chr(_base).lower())] = _code
+
+def toBytes(seq):
+    '''
+    @param seq: str, bytes or uint8 array of a sequence
+    @return: uint8 numpy array view of seq
+    '''
+    if isinstance(seq, str):
+        seq = seq.encode('ascii')
+    if isinstance(seq, np.ndarray):
+        return seq
+    return np.frombuffer(seq, dtype=np.uint8)
+
+def encodeKmers(seq, hash_length):
+    '''
+    @param seq: str, bytes or uint8 array of a sequence
+    @param hash_length: k-mer length, at most MAX_HASH_LENGTH
+    @return codes: uint64 array, codes[i] is the 2-bit encoding of seq[i:i + hash_length]
+    @return valid: bool array, valid[i] is False when seq[i:i + hash_length] contains a non ACGT base
+    '''
+    if not 0 < hash_length <= MAX_HASH_LENGTH:
+        raise ValueError("hash_length must be between 1 and %d, got %d" % (MAX_HASH_LENGTH, hash_length))
+    base_codes = _BASE_CODES[toBytes(seq)]
+    n = len(base_codes) - hash_length + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    #count bad bases with a prefix sum so each window is checked in constant time
+    bad = np.concatenate(([0], np.cumsum(base_codes == 4)))
+    valid = (bad[hash_length:] - bad[:n]) == 0
+    bits = (base_codes & 3).astype(np.uint64)
+    codes = np.zeros(n, dtype=np.uint64)
+    for j in range(hash_length):
+        codes <<= np.uint64(2)
+        codes |= bits[j:j + n]
+    return codes, valid
+
+def autoHashLength(ref_bases, read_length):
+    '''
+    @param ref_bases: number of bases in the references
+    @param read_length: longest read length that will be aligned
+    @return: k-mer length long enough that a random k-mer is expected far less than once in the references,
+             and short enough that a read still has several seeds between sequencing errors
+    '''
+    hash_length = int(np.ceil(np.log(max(ref_bases, 4)) / np.log(4))) + 2
+    if read_length > 0:
+        hash_length = min(hash_length, read_length // 4)
+    return int(min(max(hash_length, MIN_AUTO_HASH_LENGTH), MAX_HASH_LENGTH))
+
+def autoWindow(hash_length, read_length):
+    '''
+    @param hash_length: k-mer length
+    @param read_length: longest read length that will be aligned
+    @return: minimizer window of about two thirds of hash_length, so consecutive minimizers are a few bases apart,
+             kept small enough that a read has at least eight windows
+    '''
+    window = max(1, 2 * hash_length // 3)
+    if read_length > 0:
+        window = min(window, max(1, (read_length - hash_length + 1) // 8))
+    return window
+
+def mixHash(codes):
+    '''
+    @param codes: uint64 k-mer codes as made by encodeKmers
+    @return: uint64 array of an invertible mix of each code, so minimizers are not biased towards low complexity k-mers like poly-A
+    '''
+    #finalizer of murmurhash3, wrapping multiplication is what scrambles the bits
+    hashes = codes.astype(np.uint64)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xff51afd7ed558ccd)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xc4ceb9fe1a85ec53)
+    hashes ^= hashes >> np.uint64(33)
+    return hashes
+
+def minimizerPositions(codes, valid, window, chunk=1 << 20):
+    '''
+    @param codes, valid: k-mers as made by encodeKmers
+    @param window: number of consecutive k-mers to pick the minimizer of, every valid k-mer is picked if <= 1
+    @param chunk: number of windows handled in one numpy pass, bounds memory use
+    @return: sorted positions of the k-mers that are the minimizer of at least one window, invalid k-mers are never picked
+    '''
+    if window <= 1 or len(codes) == 0:
+        return np.flatnonzero(valid)
+    hashes = mixHash(codes)
+    hashes[~valid] = np.iinfo(np.uint64).max
+    window = min(window, len(hashes))
+    picked = []
+    for start in range(0, len(hashes) - window + 1, chunk):
+        windows = np.lib.stride_tricks.sliding_window_view(hashes[start:start + chunk + window - 1], window)
+        #argmin takes the leftmost of tied hashes, which is the same k-mer wherever the window is
+        picked.append(start + np.arange(len(windows)) + windows.argmin(axis=1))
+    positions = np.unique(np.concatenate(picked))
+    return positions[valid[positions]]
+
+def buildIndex(combined_ref, hash_length, read_length, reference_locs, x_locs, window=1, max_occurrences=-1):
+    '''
+    @param combined_ref: combined reference as made by aligner.processFasta
+    @param hash_length: k-mer length
+    @param read_length: length of the x padding between references in combined_ref
+    @param reference_locs: a dictionary storing where each ref is in combined ref. key=ref name value=[start, end]
+    @param x_locs: list of form [start x region, end x region, start x region 2, ...]
+    @param window: only index minimizers of this many consecutive k-mers, every k-mer is indexed if <= 1
+    @param max_occurrences: mask k-mers indexed at more positions than this, 0 to pick the threshold from the k-mer counts, -1 to mask none
+    @return: kmer_index of combined_ref
+    '''
+    ref_bytes = toBytes(combined_ref)
+    codes, valid = encodeKmers(ref_bytes, hash_length)
+    pos_dtype = np.uint32 if len(ref_bytes) < 2**32 else np.int64
+    positions = minimizerPositions(codes, valid, window).astype(pos_dtype)
+    codes = codes[positions]
+    #stable sort keeps the positions of each k-mer in increasing order
+    order = np.argsort(codes, kind='stable')
+    positions = positions[order]
+    kmers, counts = np.unique(codes[order], return_counts=True)
+    if max_occurrences == 0 and len(counts):
+        #only the most frequent tenth of a percent of k-mers is masked, and only if they are really repetitive
+        max_occurrences = max(MIN_AUTO_MAX_OCCURRENCES, int(np.percentile(counts, 99.9)))
+    masked = 0
+    if max_occurrences > 0:
+        keep = counts <= max_occurrences
+        masked = int((~keep).sum())
+        positions = positions[np.repeat(keep, counts)]
+        kmers, counts = kmers[keep], counts[keep]
+    offsets = np.zeros(len(kmers) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return kmer_index(hash_length, read_length, kmers, offsets, positions, ref_bytes, reference_locs, x_locs,
+                      max(window, 1), max_occurrences, masked)
+
+def lookup(index, codes):
+    '''
+    @param index: kmer_index
+    @param codes: array of k-mer codes as made by encodeKmers
+    @return starts, ends: positions of codes[i] in combined_ref are index.positions[starts[i]:ends[i]], empty if codes[i] is not in index
+    '''
+    if len(index.kmers) == 0:
+        empty = np.zeros(len(codes), dtype=np.int64)
+        return empty, empty
+    slots = np.minimum(np.searchsorted(index.kmers, codes), len(index.kmers) - 1)
+    found = index.kmers[slots] == codes
+    starts = index.offsets[slots]
+    ends = np.where(found, index.offsets[slots + 1], starts)
+    return starts, ends
+
+def saveIndex(index, path):
+    '''
+    @param index: kmer_index to write
+    @param path: file to write index to, written to a temporary file first so readers never see a partial index
+    '''
+    arrays = [('kmers', np.ascontiguousarray(index.kmers, dtype=np.uint64)),
+              ('offsets', np.ascontiguousarray(index.offsets, dtype=np.int64)),
+              ('positions', np.ascontiguousarray(index.positions)),
+              ('combined_ref', np.ascontiguousarray(index.combined_ref, dtype=np.uint8))]
+    header = {'hash_length': index.hash_length, 'read_length': index.read_length, 'window': index.window,
+              'max_occurrences': index.max_occurrences, 'masked': index.masked, 'reference_locs': index.reference_locs, 'x_locs': list(index.x_locs), 'arrays': {}}
+    #array offsets depend on header length, so lay out relative to the start of the array section first
+    pos = 0
+    for name, array in arrays:
+        header['arrays'][name] = {'offset': pos, 'dtype': array.dtype.str, 'length': len(array)}
+        pos += -(-array.nbytes // 8) * 8
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(INDEX_MAGIC) + 8 + len(header_bytes)) // 8) * 8
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(np.array([INDEX_VERSION, len(header_bytes)], dtype='<u4').tobytes())
+        f.write(header_bytes)
+        for name, array in arrays:
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + pos)
+    os.replace(tmp_path, path)
+    logging.debug("wrote k-mer index with %d k-mers to %s" % (len(index.kmers), path))
+
+def loadIndex(path):
+    '''
+    @param path: index file written by saveIndex
+    @return: kmer_index whose arrays are read-only memory maps of path, so processes loading the same file share its pages
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(len(INDEX_MAGIC))
+        if magic != INDEX_MAGIC:
+            raise ValueError("%s is not a k-mer index file" % path)
+        version, header_length = np.frombuffer(f.read(8), dtype='<u4')
+        if version != INDEX_VERSION:
+            raise ValueError("%s is a version %d k-mer index, expected version %d" % (path, version, INDEX_VERSION))
+        header = json.loads(f.read(int(header_length)).decode('utf-8'))
+    data_start = -(-(len(INDEX_MAGIC) + 8 + int(header_length)) // 8) * 8
+    arrays = dict()
+    for name, info in header['arrays'].items():
+        if info['length'] == 0:
+            arrays[name] = np.zeros(0, dtype=info['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=info['dtype'], mode='r', offset=data_start + info['offset'], shape=(info['length'], ))
+    return kmer_index(header['hash_length'], header['read_length'], arrays['kmers'], arrays['offsets'], arrays['positions'],
+                      arrays['combined_ref'], header['reference_locs'], header['x_locs'], header['window'], header['max_occurrences'], header['masked'])
+
+def fileDigest(path, block_size=1 << 20):
+    '''
+    @param path: file to digest
+    @return: hex sha256 digest of the contents of path
+    '''
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def indexCachePath(cache_dir, fasta, hash_length, read_length, window=0, max_occurrences=0):
+    '''
+    @param cache_dir: directory holding cached indexes
+    @param fasta: reference fasta the index is built from
+    @param hash_length: k-mer length of the index, 0 when picked by autoHashLength
+    @param read_length: length of the x padding between references
+    @param window, max_occurrences: minimizer window and masking threshold the index is built with, as given to buildIndex
+    @return: path of the cached index, named by the content of fasta so renamed or moved copies share an entry
+    '''
+    return os.path.join(cache_dir, "%s_k%d_w%d_m%d_p%d.v%d.idx" % (fileDigest(fasta)[:24], hash_length, window, max_occurrences, read_length, INDEX_VERSION))
+
+def cachedIndex(cache_dir, fasta, hash_length, read_length, build, window=0, max_occurrences=0):
+    '''
+    @param cache_dir: directory holding cached indexes, created if needed
+    @param fasta: reference fasta the index is built from
+    @param hash_length: k-mer length of the index, 0 when picked by autoHashLength
+    @param read_length: length of the x padding between references
+    @param build: function taking no arguments that returns the kmer_index to cache
+    @param window, max_occurrences: minimizer window and masking threshold build uses, see buildIndex
+    @return: path of the cached index, built by whichever process gets here first while the others wait on a lock
+    '''
+    import fcntl
+    os.makedirs(cache_dir, exist_ok=True)
+    path = indexCachePath(cache_dir, fasta, hash_length, read_length, window, max_occurrences)
+    if not os.path.exists(path):
+        with open(path + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                #another job may have built the index while we waited for the lock
+                if not os.path.exists(path):
+                    logging.info("building k-mer index %s" % path)
+                    saveIndex(build(), path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    #mark as recently used so evictIndexes keeps it
+    os.utime(path)
+    return path
+
+def evictIndexes(cache_dir, max_age_days=30):
+    '''
+    @param cache_dir: directory holding cached indexes
+    @param max_age_days: indexes not used for this many days are removed, as are indexes from other format versions and the lock files
+                         of builds over a day old
+    @return: list of removed files
+    '''
+    import re
+    import time
+    removed = []
+    if not os.path.isdir(cache_dir):
+        return removed
+    now = time.time()
+    for file in os.listdir(cache_dir):
+        full_file = os.path.join(cache_dir, file)
+        is_index = re.search(r'^(.*)\.v(\d+)\.idx(\.tmp\d+|\.lock)?$', file)
+        if not is_index:
+            continue
+        age = now - os.path.getmtime(full_file)
+        #leftover temporary files are from builds that died and every build reopens its lock, anything older than a day can not still be running
+        if is_index.group(3):
+            stale = age > 86400
+        else:
+            stale = int(is_index.group(2)) != INDEX_VERSION or age > max_age_days * 86400
+        if stale:
+            try:
+                os.remove(full_file)
+                removed.append(full_file)
+                logging.info("evicted stale k-mer index %s" % full_file)
+            except FileNotFoundError:
+                #evicted by another process
+                pass
+    return removed
@@ -0,0 +1,215 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import Counter, OrderedDict
+
+'''
+runs jobs on this machine for job_manager none
+
+a job starts as soon as the jobs it depends on are done and enough of the cpus and memory given to the scheduler are free,
+failed jobs are retried, and wait blocks until jobs finish while reporting progress
+'''
+
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+def availableCpus():
+    '''
+    @return: number of cpus this process may run on
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def availableMemoryGb():
+    '''
+    @return: memory in GB available to new processes, from /proc/meminfo where there is one, otherwise all physical memory
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / float(1 << 20)
+    except IOError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / float(1 << 30)
+
+class LocalJob(object):
+    '''A command with its resource request, the jobs it waits for and the exit status of each attempt to run it.'''
+    def __init__(self, jobid, name, command, cpus, mem_gb, depends_on, work_dir, log_file, retries):
+        self.jobid = jobid
+        self.name = name
+        self.command = command
+        self.cpus = cpus
+        self.mem_gb = mem_gb
+        self.depends_on = list(depends_on)
+        self.work_dir = work_dir
+        self.log_file = log_file
+        self.retries = retries
+        self.state = 'waiting'
+        self.returncodes = []
+        self.proc = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+    def toDict(self):
+        '''
+        @return: dictionary of the job's request and outcome, as written to the job report
+        '''
+        return {'jobid': self.jobid, 'name': self.name, 'command': self.command, 'cpus': self.cpus, 'mem_gb': self.mem_gb,
+                'depends_on': self.depends_on, 'state': self.state, 'returncodes': self.returncodes,
+                'queued_seconds': (self.started or time.time()) - self.submitted,
+                'run_seconds': (self.finished or time.time()) - self.started if self.started else 0}
+
+class LocalScheduler(object):
+    '''Bounded pool of local processes, started in submission order as their dependencies finish and resources free up.'''
+    def __init__(self, max_cpus=None, max_mem_gb=None, retries=1):
+        '''
+        @param max_cpus: cpus shared by running jobs [default: cpus available to this process]
+        @param max_mem_gb: memory in GB shared by running jobs [default: memory available now]
+        @param retries: times a job exiting with a non zero status is run again before it is marked failed
+        '''
+        self.max_cpus = max_cpus or availableCpus()
+        self.max_mem_gb = max_mem_gb or availableMemoryGb()
+        self.retries = retries
+        self.free_cpus = self.max_cpus
+        self.free_mem_gb = self.max_mem_gb
+        self.jobs = OrderedDict()
+        #guards all job state, notified every time a job changes state
+        self.changed = threading.Condition()
+        logging.info("local scheduler running jobs on %d cpus and %.1f GB of memory" % (self.max_cpus, self.max_mem_gb))
+    def submit(self, name, command, cpus=1, mem_gb=1, depends_on=(), work_dir=None, log_file=None, retries=None):
+        '''
+        @param name: name of the job, used in log messages
+        @param command: list of the program and its arguments to run
+        @param cpus, mem_gb: resources the job holds while running, capped at what the scheduler has so every job can run
+        @param depends_on: job ids that must finish successfully before this job starts, the job is cancelled if one fails
+        @param work_dir: directory to run the job in
+        @param log_file: file the job's stdout and stderr are appended to, discarded if not given
+        @param retries: retries for this job [default: retries of the scheduler]
+        @return: job id
+        '''
+        with self.changed:
+            unknown = [jobid for jobid in depends_on if jobid not in self.jobs]
+            if unknown:
+                raise ValueError("%s depends on unknown jobs %s" % (name, ", ".join(unknown)))
+            jobid = str(len(self.jobs) + 1)
+            self.jobs[jobid] = LocalJob(jobid, name, command, min(cpus, self.max_cpus), min(mem_gb, self.max_mem_gb), depends_on,
+                                        work_dir, log_file, self.retries if retries is None else retries)
+            self._schedule()
+        return jobid
+    def _schedule(self):
+        '''
+        starts every waiting job whose dependencies are done and that fits in the free cpus and memory, called holding self.changed
+        '''
+        for job in self.jobs.values():
+            if job.state != 'waiting':
+                continue
+            dependency_states = [self.jobs[jobid].state for jobid in job.depends_on]
+            #dependencies are always submitted first, so cancelling cascades down the chain in one pass
+            if 'failed' in dependency_states or 'cancelled' in dependency_states:
+                job.state = 'cancelled'
+                logging.warning("cancelled %s (job %s), a job it depends on failed" % (job.name, job.jobid))
+                continue
+            if any(state != 'done' for state in dependency_states):
+                continue
+            #smaller jobs further back may still fit while a large one waits
+            if job.cpus > self.free_cpus or job.mem_gb > self.free_mem_gb:
+                continue
+            self._start(job)
+        self.changed.notify_all()
+    def _start(self, job):
+        '''
+        launches job and a thread waiting for it to exit, called holding self.changed
+        '''
+        log = open(job.log_file, 'ab') if job.log_file else subprocess.DEVNULL
+        try:
+            job.proc = subprocess.Popen(job.command, cwd=job.work_dir, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            #a missing program will not appear on a retry
+            job.state = 'failed'
+            job.finished = time.time()
+            logging.error("could not start %s (job %s): %s" % (job.name, job.jobid, e))
+            return
+        finally:
+            if job.log_file:
+                log.close()
+        job.state = 'running'
+        job.started = time.time()
+        self.free_cpus -= job.cpus
+        self.free_mem_gb -= job.mem_gb
+        logging.info("started %s (job %s, pid %d)" % (job.name, job.jobid, job.proc.pid))
+        reaper = threading.Thread(target=self._reap, args=(job, ))
+        reaper.daemon = True
+        reaper.start()
+    def _reap(self, job):
+        '''
+        waits for the process of job to exit, records its exit status and starts whatever can run in the resources it frees
+        '''
+        returncode = job.proc.wait()
+        with self.changed:
+            self.free_cpus += job.cpus
+            self.free_mem_gb += job.mem_gb
+            job.returncodes.append(returncode)
+            job.finished = time.time()
+            if returncode == 0:
+                job.state = 'done'
+                logging.info("%s (job %s) finished in %.1f seconds" % (job.name, job.jobid, job.finished - job.started))
+            elif len(job.returncodes) <= job.retries:
+                job.state = 'waiting'
+                logging.warning("%s (job %s) exited with status %d, retrying" % (job.name, job.jobid, returncode))
+            else:
+                job.state = 'failed'
+                logging.error("%s (job %s) exited with status %d after %d attempts" % (job.name, job.jobid, returncode, len(job.returncodes)))
+            self._schedule()
+    def counts(self, jobids=None):
+        '''
+        @return: Counter of the number of jobids (all jobs by default) in each state
+        '''
+        with self.changed:
+            return Counter(self.jobs[jobid].state for jobid in (jobids or self.jobs))
+    def wait(self, jobids=None, timeout=None, progress=None):
+        '''
+        blocks until jobids (all jobs by default) are done, failed or cancelled
+        @param timeout: seconds to wait at most, None to wait until the jobs finish
+        @param progress: function called with the Counter of job states each time one changes, progress is logged when not given
+        @return: dictionary of job id to its state when wait returned
+        '''
+        if progress is None:
+            progress = lambda counts: logging.info("local jobs: %s" % ", ".join("%d %s" % (counts[state], state) for state in sorted(counts)))
+        deadline = None if timeout is None else time.time() + timeout
+        last_counts = None
+        with self.changed:
+            jobids = list(jobids or self.jobs)
+            while True:
+                states = dict((jobid, self.jobs[jobid].state) for jobid in jobids)
+                counts = Counter(states.values())
+                if counts != last_counts:
+                    progress(counts)
+                    last_counts = counts
+                if all(state in FINISHED_STATES for state in states.values()):
+                    return states
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return states
+                self.changed.wait(remaining)
+    def cancel(self):
+        '''
+        cancels every waiting job and kills every running one, so their dependents are cancelled too
+        '''
+        with self.changed:
+            for job in self.jobs.values():
+                if job.state == 'waiting':
+                    job.state = 'cancelled'
+                elif job.state == 'running':
+                    job.retries = 0
+                    job.proc.kill()
+            self.changed.notify_all()
+    def report(self):
+        '''
+        @return: list of the request and outcome of every job, in submission order
+        '''
+        with self.changed:
+            return [job.toDict() for job in self.jobs.values()]
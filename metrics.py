@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import resource
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+'''
+per run timing and counters for aligner.py
+
+each run writes <sample>_metrics.json next to its output, createAlignment.py summarizes them with summarizeMetrics
+'''
+
+def peakRss():
+    '''
+    @return: peak resident set size in MB of this process so far, and of its finished child processes
+    '''
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    #ru_maxrss is in KB on linux
+    return self_rss / 1024.0, children_rss / 1024.0
+
+class RunMetrics(object):
+    '''Wall time and peak memory of each stage of a run, plus counters of the work done in it.'''
+    def __init__(self, sample):
+        self.sample = sample
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.counters = Counter()
+    @contextmanager
+    def stage(self, name):
+        '''
+        @param name: stage to add the wall time spent in the with block to, a stage can be entered many times
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.time() - start)
+    def addTime(self, name, seconds):
+        '''
+        @param name: stage to add time to
+        @param seconds: wall time spent in stage
+        '''
+        stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'calls': 0})
+        stage['wall_seconds'] += seconds
+        stage['calls'] += 1
+        stage['peak_rss_mb'], stage['peak_children_rss_mb'] = peakRss()
+    def timed(self, name, iterable):
+        '''
+        @param name: stage to add the time spent producing items to
+        @param iterable: iterable to time, such as a generator of read batches
+        @return: generator of the items of iterable
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    def toDict(self):
+        '''
+        @return: dictionary of everything recorded, with rates derived from the counters
+        '''
+        counters = dict(self.counters)
+        peak_rss, peak_children_rss = peakRss()
+        return {'sample': self.sample, 'wall_seconds': time.time() - self.started, 'peak_rss_mb': peak_rss,
+                'peak_children_rss_mb': peak_children_rss, 'stages': self.stages, 'counters': counters,
+                'derived': deriveRates(self.stages, counters)}
+    def write(self, path):
+        '''
+        @param path: file to write metrics to as json
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.toDict(), f, indent=2)
+        logging.info("wrote metrics to %s" % path)
+
+def deriveRates(stages, counters):
+    '''
+    @param stages: dictionary of stage name to its wall_seconds, as recorded by RunMetrics
+    @param counters: dictionary of counters, as recorded by RunMetrics
+    @return: dictionary of alignment rate, mean posting list length and mapped fraction, for those that can be computed
+    '''
+    derived = dict()
+    align_seconds = stages.get('alignReads', {}).get('wall_seconds', 0)
+    if align_seconds > 0:
+        derived['reads_per_second'] = counters.get('reads', 0) / align_seconds
+    if counters.get('seed_lookups'):
+        derived['mean_posting_list_length'] = counters.get('seed_hits', 0) / float(counters['seed_lookups'])
+    if counters.get('reads'):
+        derived['mapped_fraction'] = counters.get('mapped', 0) / float(counters['reads'])
+    return derived
+
+@contextmanager
+def profiled(path, enabled=True):
+    '''
+    @param path: file to dump cProfile stats of the with block to, readable with pstats
+    @param enabled: profile only when True, so callers can pass a command line flag straight through
+    '''
+    if not enabled:
+        yield
+        return
+    import cProfile
+    import io
+    import pstats
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(25)
+        logging.info("profile written to %s\n%s" % (path, summary.getvalue()))
+
+def shardName(sample, shard, n_shards):
+    '''
+    @param shard: index of the read range of sample, from 0
+    @param n_shards: number of read ranges sample was split into
+    @return: name the output files of the shard are written under, the sample name itself when it was not split
+    '''
+    if n_shards == 1:
+        return sample
+    return "%s.shard%d" % (sample, shard)
+
+def mergeShards(out_dir, sample, n_shards):
+    '''
+    @param out_dir: directory the shards of sample wrote their <shard>_metrics.json files to
+    @param sample: sample that was split into n_shards read ranges
+    @return: path of <sample>_metrics.json combining every shard, None while some shards have not finished
+    '''
+    import fcntl
+    shard_files = [os.path.join(out_dir, "%s_metrics.json" % shardName(sample, shard, n_shards)) for shard in range(n_shards)]
+    merged_file = os.path.join(out_dir, "%s_metrics.json" % sample)
+    #shards finishing together take turns, so whichever is last sees every shard's metrics
+    with open(merged_file + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        missing = [shard_file for shard_file in shard_files if not os.path.exists(shard_file)]
+        if missing:
+            logging.info("%d of %d shards of %s still to finish" % (len(missing), n_shards, sample))
+            return None
+        shards = []
+        for shard_file in shard_files:
+            with open(shard_file) as f:
+                shards.append(json.load(f))
+        counters = Counter()
+        stages = OrderedDict()
+        for shard in shards:
+            counters.update(shard['counters'])
+            for name, info in shard['stages'].items():
+                stage = stages.setdefault(name, {'wall_seconds': 0.0, 'calls': 0, 'peak_rss_mb': 0, 'peak_children_rss_mb': 0})
+                stage['wall_seconds'] += info['wall_seconds']
+                stage['calls'] += info['calls']
+                stage['peak_rss_mb'] = max(stage['peak_rss_mb'], info['peak_rss_mb'])
+                stage['peak_children_rss_mb'] = max(stage['peak_children_rss_mb'], info['peak_children_rss_mb'])
+        counters = dict(counters)
+        #wall time is the work summed over shards, shard_wall_seconds shows how evenly it was spread
+        merged = {'sample': sample, 'wall_seconds': sum(shard['wall_seconds'] for shard in shards),
+                  'peak_rss_mb': max(shard['peak_rss_mb'] for shard in shards),
+                  'peak_children_rss_mb': max(shard['peak_children_rss_mb'] for shard in shards),
+                  'stages': stages, 'counters': counters, 'derived': deriveRates(stages, counters),
+                  'shard_wall_seconds': [shard['wall_seconds'] for shard in shards]}
+        #written to a temporary file first so a missing or partial merged file always means the sample is unfinished
+        tmp_file = "%s.tmp%d" % (merged_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(merged, f, indent=2)
+        os.replace(tmp_file, merged_file)
+    logging.info("merged metrics of %d shards of %s into %s" % (n_shards, sample, merged_file))
+    return merged_file
+
+def summarizeMetrics(out_dir, run_name):
+    '''
+    @param out_dir: directory holding the <sample>_metrics.json files of a run
+    @param run_name: name of the run, summary is written to <run_name>_summary.json in out_dir
+    @return: summary dictionary with one row per sample and totals over the run
+    '''
+    import re
+    samples = []
+    for file in sorted(os.listdir(out_dir)):
+        #shard metrics are already counted in the merged metrics of their sample
+        if re.search(r'_metrics\.json$', file) and not re.search(r'\.shard\d+_metrics\.json$', file):
+            with open(os.path.join(out_dir, file)) as f:
+                samples.append(json.load(f))
+    totals = Counter()
+    rows = []
+    for sample in samples:
+        counters = sample['counters']
+        row = {'sample': sample['sample'], 'wall_seconds': sample['wall_seconds'], 'peak_rss_mb': sample['peak_rss_mb'],
+               'reads': counters.get('reads', 0), 'mapped': counters.get('mapped', 0), 'unmapped': counters.get('unmapped', 0),
+               'reads_per_second': sample['derived'].get('reads_per_second', 0)}
+        for stage, info in sample['stages'].items():
+            row['%s_seconds' % stage] = info['wall_seconds']
+        rows.append(row)
+        totals.update(counters)
+    summary = {'run': run_name, 'samples': rows, 'totals': dict(totals), 'n_samples': len(rows)}
+    if rows:
+        summary['wall_seconds'] = sum(row['wall_seconds'] for row in rows)
+        summary['max_peak_rss_mb'] = max(row['peak_rss_mb'] for row in rows)
+        summary['slowest_sample'] = max(rows, key=lambda row: row['wall_seconds'])['sample']
+    summary_file = os.path.join(out_dir, "%s_summary.json" % run_name)
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    logging.info("Summarized metrics of %d samples in %s" % (len(rows), summary_file))
+    return summary